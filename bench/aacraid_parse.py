@@ -0,0 +1,106 @@
+#!/usr/bin/python
+
+'''aacraid_parse.py -- check and time the check_aacraid parser
+
+Every directory under fixtures/aacraid holds the output arcconf gave for
+one controller setup, one file per command (GETVERSION, GETCONFIG_1_LD,
+GETCONFIG_1_AD and so on), and an "expected" file with the exit code and
+status line check_aacraid should produce for it:
+
+    bench/aacraid_parse.py [-n 2000] [SCENARIO...]
+
+Each scenario is first parsed and evaluated once and compared to what is
+expected, then parsed again -n times to time the parser. Exits 1 if any
+scenario doesn't give the expected result.
+
+This script originally from Mark's Nagios Plugins:
+    https://github.com/xb95/nagios-plugins
+
+Copyright (c) 2012 by Bump Technologies, Inc, and authors and
+contributors. Please see the above linked repository for licensing
+information.
+
+'''
+
+import os
+import sys
+import time
+from optparse import OptionParser
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import check_aacraid
+
+FIXTURES = os.path.join(HERE, 'fixtures', 'aacraid')
+
+
+def main(argv):
+    parser = OptionParser(usage='%prog [-n ITERATIONS] [SCENARIO...]')
+    parser.add_option('-n', '--iterations', dest='iterations', type='int', default=2000,
+                      metavar='N', help='How many times to parse each scenario.')
+    (options, args) = parser.parse_args(argv[1:])
+
+    scenarios = args or sorted(os.listdir(FIXTURES))
+    failed = 0
+    print '%-20s %-6s %10s %10s' % ('scenario', 'result', 'lines', 'usec/parse')
+    for name in scenarios:
+        outputs = load(os.path.join(FIXTURES, name))
+        code, line = replay(outputs)
+        expected = outputs.pop('expected').rstrip('\n')
+        ok = '%d %s' % (code, line) == expected
+        if not ok:
+            failed += 1
+
+        nlines = sum(len(x) for x in outputs.values())
+        start = time.time()
+        for _ in xrange(options.iterations):
+            replay(outputs)
+        elapsed = (time.time() - start) / options.iterations
+        print '%-20s %-6s %10d %10.1f' % (name, ok and 'ok' or 'FAIL', nlines, elapsed * 1e6)
+        if not ok:
+            print '    expected: %s' % expected
+            print '    got:      %d %s' % (code, line)
+    return 1 if failed else 0
+
+
+def load(path):
+    '''Returns a dict mapping each file in the scenario directory to its
+    lines (or, for "expected", its text).
+
+    '''
+    ret = {}
+    for name in os.listdir(path):
+        f = open(os.path.join(path, name))
+        try:
+            if name == 'expected':
+                ret[name] = f.read()
+            else:
+                ret[name] = f.read().splitlines(True)
+        finally:
+            f.close()
+    return ret
+
+
+def replay(outputs):
+    '''Parses recorded arcconf output the way take_snapshot() parses the
+    live output, and returns the exit code and status line.
+
+    '''
+    version = {'controllers': 0}
+    check_aacraid.parse(outputs['GETVERSION'], check_aacraid.VERSION_KEYS, version)
+    snapshot = {'controllers': []}
+    for cnum in range(1, version['controllers'] + 1):
+        controller = check_aacraid.new_controller(cnum)
+        for query, keys in (('LD', check_aacraid.LD_KEYS), ('AD', check_aacraid.AD_KEYS)):
+            lines = outputs.get('GETCONFIG_%d_%s' % (cnum, query))
+            if lines is None:
+                controller['errors'].append('no recorded GETCONFIG %d %s' % (cnum, query))
+            else:
+                check_aacraid.parse(lines, keys, controller)
+        snapshot['controllers'].append(controller)
+    return check_aacraid.evaluate(snapshot)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,143 @@
+#!/usr/bin/python
+
+'''logscan_scan.py -- time check_logscan over a big log with many rules
+
+Writes a synthetic syslog of the given size (or uses the one given with
+-f) and times one full check_logscan scan of it with rule sets of
+different sizes:
+
+    bench/logscan_scan.py [-s 2048] [-r 4,100,300] [-o /var/tmp/bench.log]
+
+The 4 rule set is the built in rules. Larger sets add generated rules,
+one in ten of which has no literal text the combined search could use.
+Every rule has lines written for it in the log, so the hit counts are
+known up front and checked after each scan. With the combined search
+the time per scan should stay roughly the same as rules are added.
+
+The generated log is kept, so later runs with the same -o and -s skip
+writing it again.
+
+This script originally from Mark's Nagios Plugins:
+    https://github.com/xb95/nagios-plugins
+
+Copyright (c) 2012 by Bump Technologies, Inc, and authors and
+contributors. Please see the above linked repository for licensing
+information.
+
+'''
+
+import os
+import random
+import sys
+import time
+from optparse import OptionParser
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import check_logscan
+
+# Lines that match nothing, the bulk of any real syslog.
+NOISE = (
+    'CRON[%d]: (root) CMD (   cd / && run-parts --report /etc/cron.hourly)',
+    'postfix/smtpd[%d]: connect from unknown[10.1.2.3]',
+    'sshd[%d]: Accepted publickey for deploy from 10.0.0.5 port 51234 ssh2',
+    'kernel: [%d.123456] eth0: no IPv6 routers present',
+    'nginx[%d]: 10.2.3.4 - - "GET /api/v1/items HTTP/1.1" 200 5123',
+    'dhclient[%d]: DHCPACK from 10.0.0.1 (xid=0x1a2b3c4d)',
+)
+CHUNK_LINES = 20000
+
+
+def main(argv):
+    parser = OptionParser(usage='%prog [-s MB] [-r 4,100,300] [-o FILE | -f FILE]')
+    parser.add_option('-s', '--size', dest='size', type='int', default=2048,
+                      metavar='MB', help='Size of the generated log.')
+    parser.add_option('-r', '--rules', dest='rules', default='4,100,300',
+                      metavar='COUNTS', help='Rule set sizes to time, comma separated.')
+    parser.add_option('-o', '--output', dest='output', default='/var/tmp/logscan_bench.log',
+                      metavar='FILE', help='Where to write the generated log.')
+    (options, args) = parser.parse_args(argv[1:])
+
+    try:
+        counts = [int(x) for x in options.rules.split(',')]
+    except ValueError:
+        parser.error('--rules must be a list of numbers.')
+    if min(counts) < 4:
+        parser.error('The smallest rule set is the 4 built in rules.')
+
+    rules = generated_rules(max(counts))
+    chunk, per_chunk = make_chunk(rules)
+    path = options.output
+    want = options.size * 1024 * 1024 // len(chunk)
+    if not os.path.exists(path) or os.path.getsize(path) != want * len(chunk):
+        print 'writing %d MB to %s' % (want * len(chunk) // (1024 * 1024), path)
+        f = open(path, 'wb')
+        try:
+            for _ in xrange(want):
+                f.write(chunk)
+        finally:
+            f.close()
+    size = os.path.getsize(path)
+
+    print '%6s %10s %8s %10s  %s' % ('rules', 'seconds', 'MB/s', 'hits', 'check')
+    failed = False
+    for count in counts:
+        text = check_logscan.DEFAULT_RULES + '\n'.join(rules[:count - 4])
+        matcher = check_logscan.Matcher(check_logscan.parse_rules(text, 'bench'))
+        state = {'code': 0, 'message': '', 'hits': {}}
+        start = time.time()
+        check_logscan.scan(path, 0, state, matcher)
+        elapsed = time.time() - start
+
+        expected = {}
+        for desc, n in per_chunk.items():
+            if desc.startswith('bench ') and int(desc.split()[1]) >= count - 4:
+                continue
+            expected[desc] = n * want
+        ok = state['hits'] == expected
+        failed = failed or not ok
+        print '%6d %10.2f %8.1f %10d  %s' % (count, elapsed, size / elapsed / (1024 * 1024),
+                                             sum(state['hits'].values()), ok and 'ok' or 'FAIL')
+    return 1 if failed else 0
+
+
+def generated_rules(count):
+    '''Returns rule lines for the bench rules. Every tenth one starts with
+    a character class, so it has no literal and is searched on its own.
+
+    '''
+    ret = []
+    for i in range(count):
+        if i % 10 == 9:
+            ret.append('WARNING | raise | bench %d | [a-z]+d\\[[0-9]+\\]: bench fault %d$' % (i, i))
+        else:
+            ret.append('WARNING | raise | bench %d | app%d: request failed with code [0-9]+' % (i, i))
+    return ret
+
+
+def make_chunk(rules):
+    '''Returns a block of log text that is repeated to make up the log,
+    and how many lines in it each rule (by description) matches.
+
+    '''
+    rand = random.Random(42)
+    lines, hits = [], {}
+    for i in range(CHUNK_LINES):
+        lines.append('Oct 18 21:40:07 host%02d %s' % (rand.randint(0, 99),
+                                                   NOISE[i % len(NOISE)] % rand.randint(1, 65535)))
+    inject = [('Device failure, array offline', 'kernel: md0: offlined - array failed'),
+              ('nf_conntrack: table full', 'kernel: nf_conntrack: table full, dropping packet')]
+    for i in range(len(rules)):
+        if i % 10 == 9:
+            inject.append(('bench %d' % i, 'workerd[%d]: bench fault %d' % (i, i)))
+        else:
+            inject.append(('bench %d' % i, 'app%d: request failed with code 503' % i))
+    for desc, message in inject:
+        lines.insert(rand.randint(0, len(lines)), 'Oct 18 21:40:07 host01 ' + message)
+        hits[desc] = hits.get(desc, 0) + 1
+    return '\n'.join(lines) + '\n', hits
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
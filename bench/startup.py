@@ -0,0 +1,257 @@
+#!/usr/bin/python
+
+'''startup.py -- measure how long the plugins take to get going
+
+A plugin run from Nagios pays for a Python startup, its imports and its
+option parsing before it does any real work, thousands of times per
+check interval. For every plugin this measures, as the best of -n runs:
+
+    import   python -c "import check_x", with no work done at all
+    first    from starting the plugin to the first byte of its request
+             arriving at a stub server (plugins that talk to one)
+    total    the whole run, against the stub or against local files
+
+The stubs are an HTTP server that answers like Riak and TSD, a Redis
+server, and a TCP port that stands in for a TLS endpoint. check_logscan
+reads a small generated log and check_aacraid reads a snapshot, since
+neither talks to a server.
+
+    bench/startup.py [-n 10] [--tree DIR] [--save FILE] [--compare FILE]
+
+--tree times the plugins in another checkout, such as an older commit
+from git worktree, so both sides can be measured on the same machine.
+--save writes the numbers out, and --compare checks them against saved
+ones and exits 1 if any got more than --tolerance percent slower.
+
+This script originally from Mark's Nagios Plugins:
+    https://github.com/xb95/nagios-plugins
+
+Copyright (c) 2012 by Bump Technologies, Inc, and authors and
+contributors. Please see the above linked repository for licensing
+information.
+
+'''
+
+import BaseHTTPServer
+import SocketServer
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from optparse import OptionParser
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TOP = os.path.dirname(HERE)
+
+# When the stubs last saw the first byte of a request. Reset before every
+# plugin run.
+first_byte = [None]
+
+
+def saw_first_byte():
+    if first_byte[0] is None:
+        first_byte[0] = time.time()
+
+
+class HTTPStub(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def parse_request(self):
+        saw_first_byte()
+        return BaseHTTPServer.BaseHTTPRequestHandler.parse_request(self)
+
+    def do_GET(self):
+        if self.path.startswith('/stats'):
+            body = json.dumps({
+                'node_get_fsm_time_95': 1000, 'node_put_fsm_time_95': 2000,
+                'connected_nodes': [], 'ring_ownership': "[{'riak@127.0.0.1',64}]",
+            })
+        else:
+            now = int(time.time())
+            body = ''.join('m %d %d host=a\n' % (now - 60 * i, 100 + i) for i in range(10))
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class RedisStub(SocketServer.StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            saw_first_byte()
+            for _ in range(int(line[1:])):
+                self.rfile.readline()
+                self.rfile.readline()
+            info = 'role:master\r\nconnected_slaves:0\r\nmaster_repl_offset:0\r\n'
+            self.wfile.write('$%d\r\n%s\r\n' % (len(info), info))
+
+
+class TLSStub(SocketServer.BaseRequestHandler):
+    '''Notes the ClientHello and hangs up; the handshake time is of no
+    interest here.
+
+    '''
+    def handle(self):
+        if self.request.recv(1):
+            saw_first_byte()
+
+
+class Server(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def serve(handler):
+    server = Server(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server.server_address[1]
+
+
+def main(argv):
+    parser = OptionParser(usage='%prog [-n RUNS] [--tree DIR] [--save FILE] [--compare FILE]')
+    parser.add_option('-n', '--runs', dest='runs', type='int', default=10,
+                      metavar='N', help='Report the best of N runs.')
+    parser.add_option('--tree', dest='tree', default=TOP, metavar='DIR',
+                      help='Time the plugins in DIR instead of this checkout.')
+    parser.add_option('--save', dest='save', metavar='FILE',
+                      help='Save the results to FILE.')
+    parser.add_option('--compare', dest='compare', metavar='FILE',
+                      help='Compare the results to those saved in FILE.')
+    parser.add_option('--tolerance', dest='tolerance', type='float', default=20,
+                      metavar='PERCENT', help='How much slower than saved is a regression.')
+    (options, args) = parser.parse_args(argv[1:])
+    if options.runs < 1:
+        parser.error('--runs must be at least 1.')
+    tree = os.path.abspath(options.tree)
+    if not os.path.exists(os.path.join(tree, 'plugin_runtime.py')):
+        parser.error('%s has no plugins in it.' % tree)
+
+    http, redis, tls = serve(HTTPStub), serve(RedisStub), serve(TLSStub)
+    tmp = tempfile.mkdtemp(prefix='startup')
+    try:
+        log = os.path.join(tmp, 'syslog')
+        f = open(log, 'w')
+        f.write('Oct 18 21:40:07 host01 CRON[123]: (root) CMD (true)\n' * 1000)
+        f.close()
+        snapshot = os.path.join(tmp, 'aacraid.json')
+        f = open(snapshot, 'w')
+        json.dump({'time': int(time.time()) + 86400, 'controllers': []}, f)
+        f.close()
+
+        plugins = [
+            ('check_riak', ['-H', '127.0.0.1', '-p', str(http), '--95th', '10,20,10,20'], True),
+            ('check_riak_ring', ['-p', str(http), '127.0.0.1'], True),
+            ('check_tsd', ['-H', '127.0.0.1', '-p', str(http), '-m', 'm', '-w', '1000'], True),
+            ('check_redis_repl', ['-H', '127.0.0.1', '-p', str(redis)], True),
+            ('check_stud_server', ['-t', '2', '127.0.0.1:%d' % tls], True),
+            ('check_logscan', ['-f', log, '-s', os.path.join(tmp, 'state')], False),
+            ('check_aacraid', ['-s', snapshot], False),
+        ]
+
+        results = {'python': best(options.runs, lambda: timed(tree, [sys.executable, '-c', 'pass']))}
+        print 'python startup alone: %.1fms' % (results['python'] * 1000)
+        print
+        print '%-18s %9s %9s %9s' % ('plugin', 'import', 'first', 'total')
+        for name, args, network in plugins:
+            script = os.path.join(tree, name + '.py')
+            imported = best(options.runs, lambda: timed(tree, [sys.executable, '-c', 'import ' + name]))
+            runs = [run_plugin(tree, [sys.executable, script] + args) for _ in range(options.runs)]
+            total = min(r[1] for r in runs)
+            first = None
+            if network:
+                first = min(r[0] for r in runs if r[0] is not None)
+            results[name] = {'import': imported, 'first': first, 'total': total}
+            print '%-18s %7.1fms %9s %7.1fms' % (name, imported * 1000,
+                  '%.1fms' % (first * 1000) if first is not None else '-', total * 1000)
+    finally:
+        shutil.rmtree(tmp)
+
+    if options.save:
+        f = open(options.save, 'w')
+        json.dump(results, f, indent=1, sort_keys=True)
+        f.close()
+    if options.compare:
+        f = open(options.compare)
+        try:
+            saved = json.load(f)
+        finally:
+            f.close()
+        return compare(saved, results, options.tolerance)
+    return 0
+
+
+def best(runs, func):
+    return min(func() for _ in range(runs))
+
+
+def timed(tree, cmd):
+    start = time.time()
+    subprocess.call(cmd, cwd=tree, env=environment(tree))
+    return time.time() - start
+
+
+def run_plugin(tree, cmd):
+    '''Runs one plugin and returns (seconds to the first byte a stub saw
+    or None, seconds for the whole run).
+
+    '''
+    first_byte[0] = None
+    devnull = open(os.devnull, 'w')
+    try:
+        start = time.time()
+        subprocess.call(cmd, cwd=tree, env=environment(tree), stdout=devnull, stderr=devnull)
+        end = time.time()
+    finally:
+        devnull.close()
+    if first_byte[0] is None:
+        return None, end - start
+    return first_byte[0] - start, end - start
+
+
+def environment(tree):
+    '''Runs the plugins without writing .pyc files, so every run pays
+    the same.
+
+    '''
+    env = dict(os.environ)
+    env['PYTHONDONTWRITEBYTECODE'] = '1'
+    env['PYTHONPATH'] = tree
+    return env
+
+
+def compare(saved, results, tolerance):
+    '''Prints every number that got more than tolerance percent slower than
+    the saved one. Returns 1 if there were any, 0 otherwise.
+
+    '''
+    slower = []
+    for name in sorted(results):
+        if name == 'python' or name not in saved:
+            continue
+        for key in ('import', 'first', 'total'):
+            old, new = saved[name].get(key), results[name][key]
+            if old and new and new > old * (1 + tolerance / 100.0):
+                slower.append('%s %s: %.1fms -> %.1fms' % (name, key, old * 1000, new * 1000))
+    if slower:
+        print
+        print 'Slower than %.0f%% over the saved results:' % tolerance
+        for line in slower:
+            print '    ' + line
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -2,18 +2,27 @@
 #
 # check-aacraid.py
 #
-# Grabs the output from "/usr/StorMan/arcconf GETCONFIG 1 LD" then
+# Grabs the output from "/usr/StorMan/arcconf GETVERSION" to find out
+# how many controllers are installed, then runs the queries below for
+# every controller at the same time.
+#
+# Grabs the output from "/usr/StorMan/arcconf GETCONFIG N LD" then
 # determines the health of the Logical Devices.
 #
-# Grabs the output from "/usr/StorMan/arcconf GETCONFIG 1 AL" then
+# Grabs the output from "/usr/StorMan/arcconf GETCONFIG N AD" then
 # determines the health of various status indicators from the card
 # and drives.
 #
 # After the checks are run, it deletes the file "UcliEvt.log" from
 # the current working directory.
 #
+# To keep arcconf off the Nagios check path, run a collector from cron
+# or as a daemon, and point the check at the snapshot it writes:
+#   check_aacraid.py --collect -s /var/run/aacraid.json -i 300
+#   check_aacraid.py -s /var/run/aacraid.json -a 900
+#
 # Add this to your "/etc/sudoers" file:
-# "nagios ALL=(root) NOPASSWD: /usr/StorMan/arcconf GETCONFIG 1 *"
+# "nagios ALL=(root) NOPASSWD: /usr/StorMan/arcconf GETVERSION, /usr/StorMan/arcconf GETCONFIG *"
 # Alternately, run this script as a user who can sudo.
 #
 # v0.1 - only checks card information so far, not drives yet
@@ -22,6 +31,17 @@
 #        the failure
 # v0.4 - fixed for modern Python compatibility (subprocess vs popen4)
 # v0.5 - do not alert on the BBU "Charging" state
+# v0.6 - check every controller, run the arcconf calls concurrently and
+#        kill any call that exceeds --timeout
+# v0.7 - collector mode: "--collect -s FILE [-i SECONDS]" runs arcconf on
+#        its own schedule and writes a snapshot that "-s FILE" then checks
+# v0.8 - report every battery "Status" line again, not just the last one
+# v0.9 - give up on an arcconf call at --timeout even if it won't die;
+#        sudo passes on SIGTERM but can't pass on SIGKILL
+#
+# Recorded arcconf output for a range of controller and battery states is
+# kept in bench/fixtures/aacraid; bench/aacraid_parse.py checks that it
+# still parses to the expected status and times the parser.
 #
 # LICENSE/COPYRIGHT
 #
@@ -37,116 +57,93 @@
 #
 
 
-import sys, os, re, string, subprocess
+# Only what every mode needs is imported up here. Checking a snapshot is
+# meant to be as cheap as possible, so subprocess, threading and friends
+# are imported by the functions that run arcconf.
+import sys, os, string, time
+from optparse import OptionParser
 
-c_status_re = re.compile('^\s*Controller Status\s*:\s*(.*)$')
-l_status_re = re.compile('^\s*Status of logical device\s*:\s*(.*)$')
-l_device_re = re.compile('^Logical device number ([0-9]+).*$')
-c_defunct_re = re.compile('^\s*Defunct disk drive count\s:\s*([0-9]+).*$')
-c_degraded_re = re.compile('^\s*Logical devices/Failed/Degraded\s*:\s*([0-9]+)/([0-9]+)/([0-9]+).*$')
-b_status_re = re.compile('^\s*Status\s*:\s*(.*)$')
-b_temp_re = re.compile('^\s*Over temperature\s*:\s*(.*)$')
-b_capacity_re = re.compile('\s*Capacity remaining\s*:\s*([0-9]+)\s*percent.*$')
-b_time_re = re.compile('\s*Time remaining \(at current draw\)\s*:\s*([0-9]+) days, ([0-9]+) hours, ([0-9]+) minutes.*$')
+from plugin_runtime import Run
+
+ARCCONF = "/usr/bin/sudo /usr/StorMan/arcconf"
+
+# Nagios states ordered from best to worst, used to roll up the results of
+# several controllers into a single exit code.
+severity = (0, 1, 3, 2)
 
 def main(argv):
-    cstatus = lstatus = ldevice = cdefunct = cdegraded = bstatus = btemp = bcapacity = btime = ""
-    lnum = result = ""
-    check_status = 0
+    parser = OptionParser(prog=os.path.basename(argv[0]))
+    parser.add_option('-t', '--timeout', dest='timeout', type='int', default=30,
+                      metavar='SECONDS', help='Kill any arcconf call that runs longer than this.')
+    parser.add_option('-s', '--state-file', dest='state_file', metavar='FILE',
+                      help='Check the snapshot in FILE instead of running arcconf.')
+    parser.add_option('-a', '--max-age', dest='max_age', type='int', default=900,
+                      metavar='SECONDS', help='Go critical if the snapshot is older than this.')
+    parser.add_option('--collect', dest='collect', action='store_true', default=False,
+                      help='Run arcconf and write the snapshot to the state file.')
+    parser.add_option('-i', '--interval', dest='interval', type='int', default=0,
+                      metavar='SECONDS', help='With --collect, keep collecting every SECONDS.')
+    (options, args) = parser.parse_args(argv[1:])
 
-    for line in exec_and_read("/usr/bin/sudo /usr/StorMan/arcconf GETCONFIG 1 LD"):
-        # Match the regexs
-        ldevice = l_device_re.match(line)
-        if ldevice:
-            lnum = ldevice.group(1)
-            continue
+    if options.collect and not options.state_file:
+        parser.error('--collect requires a state file (-s).')
+    elif options.interval < 0:
+        parser.error('--interval must be positive.')
 
-        lstatus = l_status_re.match(line)
-        if lstatus:
-            if lstatus.group(1) != "Optimal":
-                check_status = 2
-            result += "Logical Device " + lnum + " " + lstatus.group(1) + ","
-
-    for line in exec_and_read("/usr/bin/sudo /usr/StorMan/arcconf GETCONFIG 1 AD"):
-        # Match the regexs
-        cstatus = c_status_re.match(line)
-        if cstatus:
-            if cstatus.group(1) != "Optimal":
-                check_status = 2
-            result += "Controller " + cstatus.group(1) + ","
-            continue
+    if options.collect:
+        next_run = time.time()
+        while True:
+            # A full disk or a permissions problem shouldn't kill a long
+            # running collector; complain and try again next time.
+            try:
+                write_snapshot(options.state_file, take_snapshot(options.timeout))
+                failed = False
+            except (IOError, OSError), e:
+                print >>sys.stderr, 'Unable to write snapshot %s: %s' % (options.state_file, e)
+                failed = True
+            if not options.interval:
+                sys.exit(int(failed))
+            next_run += options.interval
+            time.sleep(max(next_run - time.time(), 0))
 
-        cdefunct = c_defunct_re.match(line)
-        if cdefunct:
-            if int(cdefunct.group(1)) > 0:
-                check_status = 2
-                result += "Defunct drives " + cdefunct.group(1) + ","
-            continue
+    run = Run()
+    if options.state_file:
+        try:
+            snapshot = read_snapshot(options.state_file)
+        except (IOError, ValueError), e:
+            sys.exit(run.unknown("Unable to read arcconf snapshot %s: %s" %
+                                 (options.state_file, e)))
+        age = int(time.time()) - snapshot.get('time', 0)
+        if age > options.max_age:
+            sys.exit(run.critical("arcconf snapshot is %d seconds old (>%ds)" %
+                                  (age, options.max_age)))
+    else:
+        with run.phase('arcconf'):
+            snapshot = take_snapshot(options.timeout)
 
-        cdegraded = c_degraded_re.match(line)
-        if cdegraded:
-            if int(cdegraded.group(2)) > 0:
-                check_status = 2
-                result += "Failed drives " + cdegraded.group(2) + ","
-            if int(cdegraded.group(3)) > 0:
-                check_status = 2
-                result += "Degraded drives " + cdegraded.group(3) + ","
-            continue
+    check_status, result = evaluate(snapshot)
+    sys.exit(run.emit(check_status, result))
 
-        bstatus = b_status_re.match(line)
-        if bstatus:
-            if bstatus.group(1) == "Not Installed":
-                continue
 
-            if bstatus.group(1) == "Charging":
-                # this sets WARNING if the status is charging, but we seem to get
-                # that pretty frequently, so don't do that.  maybe need this?
-                #if check_status < 2:
-                #    check_status = 1
-                pass
-            elif "Optimal" not in bstatus.group(1):
-                check_status = 2
-            result += "Battery Status " + bstatus.group(1) + ","
-            continue
+def worst(a, b):
+    '''Returns whichever of the two Nagios states is the more severe.'''
+    return max(a, b, key=severity.index)
 
-        btemp = b_temp_re.match(line)
-        if btemp:
-            if btemp.group(1) != "No":
-                check_status = 2
-                result += "Battery Overtemp " + btemp.group(1) + ","
-            continue
 
-        bcapacity = b_capacity_re.match(line)
-        if bcapacity:
-            result += "Battery Capacity " + bcapacity.group(1) + "%,"
-            if int(bcapacity.group(1)) < 50:
-                if check_status < 2:
-                    check_status = 1
-            if int(bcapacity.group(1)) < 25:
-                check_status = 2
-            continue
+def take_snapshot(timeout):
+    '''Runs arcconf against every controller and returns the parsed state
+    as a dict that can be stored in the state file.
 
-        btime = b_time_re.match(line)
-        if btime:
-            timemins = int(btime.group(1)) * 1440 + int(btime.group(2)) * 60 + int(btime.group(3))
-            if timemins < 1440:
-                if check_status < 2:
-                    check_status = 1
-            if timemins < 720:
-                check_status = 2
-            result += "Battery Time "
-            if timemins < 60:
-                result += str(timemins) + "mins,"
-            else:
-                result += str(timemins/60) + "hours,"
-
-    if result == "":
-        result = "No output from arcconf!"
-        check_status = 3
-
-    # strip the trailing "," from the result string.
-    result = result.rstrip(",")
-    print result
+    '''
+    snapshot = {'controllers': []}
+    controllers = get_controllers(timeout)
+    if controllers is None:
+        snapshot['error'] = "Unable to execute arcconf."
+    else:
+        for cnum in controllers:
+            snapshot['controllers'].append(new_controller(cnum))
+        collect(snapshot['controllers'], timeout)
+    snapshot['time'] = int(time.time())
 
     # we often have a log file sitting around... kill it
     try:
@@ -154,18 +151,338 @@ def main(argv):
     except:
         pass
 
-    sys.exit(check_status)
+    return snapshot
 
 
-def exec_and_read(cmd):
-    proc = subprocess.Popen(cmd.split(), stdout=subprocess.PIPE)
-    stdout, _ = proc.communicate()
-    if proc.returncode == 0:
-        return stdout.split("\n")
-    else:
-        print "Unable to execute arcconf."
-        sys.exit(3)
+def new_controller(cnum):
+    '''Returns the empty state of one controller, for parse() to fill in.'''
+    return {
+        'controller': cnum, 'errors': [], 'status': None,
+        'defunct': None, 'failed': None, 'degraded': None,
+        'battery_status': [], 'battery_overtemp': None,
+        'battery_capacity': None, 'battery_time': None,
+        'logical_devices': [],
+    }
+
+
+def write_snapshot(path, snapshot):
+    '''Atomically replaces the state file with the given snapshot, so the
+    check never reads a half written file.
+
+    '''
+    import json, tempfile
+    fd, tmp = tempfile.mkstemp(prefix='.aacraid', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        f = os.fdopen(fd, 'w')
+        json.dump(snapshot, f)
+        f.close()
+        os.chmod(tmp, 0644)
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+def read_snapshot(path):
+    import json
+    f = open(path)
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+
+def evaluate(snapshot):
+    '''Returns the Nagios state and status line for a snapshot.'''
+    if 'error' in snapshot:
+        return 3, snapshot['error']
+
+    check_status = 0
+    results = []
+    controllers = snapshot['controllers']
+    for controller in controllers:
+        status, result = evaluate_controller(controller)
+        if not result:
+            result.append("No output from arcconf!")
+            status = worst(status, 3)
+
+        check_status = worst(check_status, status)
+        if len(controllers) > 1:
+            results.append("c%d: %s" % (controller['controller'], ",".join(result)))
+        else:
+            results.append(",".join(result))
+
+    if not results:
+        return 3, "No output from arcconf!"
+    return check_status, " ".join(results)
+
+
+def evaluate_controller(c):
+    check_status = 0
+    result = []
+
+    for error in c['errors']:
+        check_status = worst(check_status, 3)
+        result.append(error)
+
+    for lnum, lstatus in c['logical_devices']:
+        if lstatus != "Optimal":
+            check_status = 2
+        result.append("Logical Device " + lnum + " " + lstatus)
+
+    if c['status'] is not None:
+        if c['status'] != "Optimal":
+            check_status = 2
+        result.append("Controller " + c['status'])
+
+    if c['defunct'] > 0:
+        check_status = 2
+        result.append("Defunct drives %d" % c['defunct'])
+
+    if c['failed'] > 0:
+        check_status = 2
+        result.append("Failed drives %d" % c['failed'])
+    if c['degraded'] > 0:
+        check_status = 2
+        result.append("Degraded drives %d" % c['degraded'])
+
+    bstatuses = c['battery_status']
+    if bstatuses is None or isinstance(bstatuses, basestring):
+        # snapshot written before v0.8
+        bstatuses = [bstatuses] if bstatuses else []
+    for bstatus in bstatuses:
+        if bstatus == "Not Installed":
+            continue
+        if bstatus == "Charging":
+            # this sets WARNING if the status is charging, but we seem to get
+            # that pretty frequently, so don't do that.  maybe need this?
+            #if check_status < 2:
+            #    check_status = 1
+            pass
+        elif "Optimal" not in bstatus:
+            check_status = 2
+        result.append("Battery Status " + bstatus)
+
+    if c['battery_overtemp'] is not None and c['battery_overtemp'] != "No":
+        check_status = 2
+        result.append("Battery Overtemp " + c['battery_overtemp'])
+
+    bcapacity = c['battery_capacity']
+    if bcapacity is not None:
+        result.append("Battery Capacity %d%%" % bcapacity)
+        if bcapacity < 50:
+            if check_status < 2:
+                check_status = 1
+        if bcapacity < 25:
+            check_status = 2
+
+    timemins = c['battery_time']
+    if timemins is not None:
+        if timemins < 1440:
+            if check_status < 2:
+                check_status = 1
+        if timemins < 720:
+            check_status = 2
+        if timemins < 60:
+            result.append("Battery Time " + str(timemins) + "mins")
+        else:
+            result.append("Battery Time " + str(timemins/60) + "hours")
+
+    return check_status, result
+
+
+def get_controllers(timeout):
+    '''Returns the list of controller numbers arcconf knows about, or None
+    if arcconf could not be run.
+
+    '''
+    version = {'controllers': 0}
+    try:
+        parse(exec_and_read(ARCCONF + " GETVERSION", timeout), VERSION_KEYS, version)
+    except ArcconfError:
+        return None
+    return range(1, version['controllers'] + 1)
+
+
+def collect(controllers, timeout):
+    '''Runs the LD and AD queries for every controller concurrently, each
+    one parsed into its controller dict as the output streams in.
+
+    '''
+    import threading
+    threads = []
+    def run(controller, query, keys):
+        cmd = "%s GETCONFIG %d %s" % (ARCCONF, controller['controller'], query)
+        try:
+            parse(exec_and_read(cmd, timeout), keys, controller)
+        except ArcconfError:
+            controller['errors'].append(
+                "arcconf GETCONFIG %d %s failed" % (controller['controller'], query))
+        except Exception, e:
+            # Never let a bad line end up as an OK with the rest unparsed.
+            controller['errors'].append("Unable to parse arcconf GETCONFIG %d %s: %s"
+                                        % (controller['controller'], query, e))
+
+    for controller in controllers:
+        for query, keys in (('LD', LD_KEYS), ('AD', AD_KEYS)):
+            thread = threading.Thread(target=run, args=(controller, query, keys))
+            thread.start()
+            threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+
+def parse(lines, keys, result):
+    '''Parses arcconf output into the result dict. Every line looks like
+    "Key : value" and is dispatched on its key through the keys table;
+    lines without a colon, like "Logical device number 0", are split on
+    their last word instead. Lines with an unknown key, and values that
+    don't parse (such as an empty count), are skipped.
+
+    '''
+    for line in lines:
+        key, sep, value = line.partition(':')
+        key = key.strip()
+        if not sep:
+            key, _, value = key.rpartition(' ')
+        handler = keys.get(key)
+        if handler is None:
+            continue
+        try:
+            handler(result, value.strip())
+        except (ValueError, IndexError):
+            pass
+
+
+def setter(field, convert=str):
+    def handler(result, value):
+        result[field] = convert(value)
+    return handler
+
+
+def appender(field):
+    def handler(result, value):
+        result[field].append(value)
+    return handler
+
+
+def leading_int(value):
+    '''Converts a value like "2" or "2 (some note)" to an int.'''
+    return int(value.split()[0])
+
+
+def ld_number(controller, value):
+    controller['logical_devices'].append([value, None])
+
+
+def ld_status(controller, value):
+    lds = controller['logical_devices']
+    if not lds or lds[-1][1] is not None:
+        lds.append(["", None])
+    lds[-1][1] = value
+
+
+def ad_counts(controller, value):
+    _, failed, degraded = [int(x) for x in value.split()[0].split('/')]
+    controller['failed'], controller['degraded'] = failed, degraded
+
+
+def battery_capacity(controller, value):
+    controller['battery_capacity'] = int(value.split()[0])
+
+
+def battery_time(controller, value):
+    import re
+    btime = re.match('^([0-9]+) days, ([0-9]+) hours, ([0-9]+) minutes', value)
+    if btime:
+        controller['battery_time'] = (int(btime.group(1)) * 1440 +
+            int(btime.group(2)) * 60 + int(btime.group(3)))
+
+
+VERSION_KEYS = {
+    'Controllers found': setter('controllers', leading_int),
+}
+LD_KEYS = {
+    'Logical device number': ld_number,
+    'Status of logical device': ld_status,
+}
+AD_KEYS = {
+    'Controller Status': setter('status'),
+    'Defunct disk drive count': setter('defunct', leading_int),
+    'Logical devices/Failed/Degraded': ad_counts,
+    'Status': appender('battery_status'),
+    'Over temperature': setter('battery_overtemp'),
+    'Capacity remaining': battery_capacity,
+    'Time remaining (at current draw)': battery_time,
+}
+
+
+class ArcconfError(Exception):
+    pass
+
+
+def exec_and_read(cmd, timeout):
+    '''Runs cmd and yields its output line by line as arcconf writes it.
+    Raises ArcconfError if the command failed or did not finish within
+    timeout seconds. The output is read against the deadline rather than
+    with readline, so we give up on time even if arcconf hangs on to its
+    stdout after being told to stop.
+
+    '''
+    import select, subprocess
+    try:
+        proc = subprocess.Popen(cmd.split(), stdout=subprocess.PIPE)
+    except OSError, e:
+        raise ArcconfError(str(e))
+    deadline = time.time() + timeout
+    fd = proc.stdout.fileno()
+    buf = ''
+    try:
+        while True:
+            left = deadline - time.time()
+            if left <= 0:
+                raise ArcconfError("%s timed out after %ds" % (cmd, timeout))
+            try:
+                if not select.select([fd], [], [], left)[0]:
+                    continue
+            except select.error:
+                continue
+            data = os.read(fd, 65536)
+            if not data:
+                break
+            lines = (buf + data).split('\n')
+            buf = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        if buf:
+            yield buf
+        while proc.poll() is None:
+            if time.time() >= deadline:
+                raise ArcconfError("%s timed out after %ds" % (cmd, timeout))
+            time.sleep(0.05)
+    finally:
+        proc.stdout.close()
+        if proc.returncode is None:
+            stop(proc)
+    if proc.returncode != 0:
+        raise ArcconfError("%s exited with %d" % (cmd, proc.returncode))
+
+
+def stop(proc):
+    '''Asks proc to exit and reaps it in the background. This has to be
+    SIGTERM: proc is sudo, which passes SIGTERM on to arcconf but dies on
+    SIGKILL and leaves arcconf running.
+
+    '''
+    import threading
+    try:
+        proc.terminate()
+    except OSError:
+        pass
+    reaper = threading.Thread(target=proc.wait)
+    reaper.daemon = True
+    reaper.start()
 
 
 if __name__ == '__main__':
-    main(sys.argv[1:])
+    main(sys.argv)
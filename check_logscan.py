@@ -0,0 +1,440 @@
+#!/usr/bin/python
+
+'''check_logscan.py -- an incremental syslog scanner for Nagios
+
+This does the same job as check_syslog.pl, looking for messages that
+reliably show up in the system log when something common goes wrong,
+without rereading the whole log on every run. The inode and offset we
+stopped at are kept in a state file together with the current alert
+state, so each run only reads the bytes appended since the last one.
+
+If the log has been rotated since the last run, the rest of the rotated
+file (LOG.1, matched by inode) is read first, and then the new log is
+read from the start. A log that shrank in place (copytruncate) is read
+from the start as well.
+
+Usage:
+    check_logscan.py [-f /var/log/syslog] [-s STATEFILE] [-r RULEFILE]
+
+The state file defaults to one in /var/tmp named after the log, so checks
+on different logs don't share one.
+
+The messages to look for come from a rule file, one rule per line:
+
+    SEVERITY | clear/raise | description | regex
+
+SEVERITY is OK, WARNING or CRITICAL. A "raise" rule only ever makes the
+alert state worse, a "clear" rule sets it to SEVERITY no matter what it
+was. The status line becomes "SEVERITY: description" of the rule that
+set it. The regex is matched case insensitively anywhere in the line,
+and when several rules match the same line the first one wins. Blank
+lines and lines starting with # are ignored. Without -r, the rules
+check_syslog.pl has always used are loaded.
+
+The perfdata holds the number of lines each rule has matched since the
+state file was created, labelled with the rule's description. When more
+than one rule has the same description, the second one is labelled
+"description #2" and so on. Counts for rules that are no longer loaded
+are dropped.
+
+Like check_syslog.pl, an alert stays up until the log shows an rsyslogd
+restart or a "force-syslog-all-clear" message. You can also reset it by
+running with --clear, which resets the alert state in the state file
+without touching syslog.
+
+This script originally from Mark's Nagios Plugins:
+    https://github.com/xb95/nagios-plugins
+
+Copyright (c) 2012 by Bump Technologies, Inc, and authors and
+contributors. Please see the above linked repository for licensing
+information.
+
+'''
+
+import json
+import mmap
+import os
+import re
+import string
+import sys
+import thread
+from optparse import OptionParser
+
+from plugin_runtime import Run
+
+
+STATES = ('OK', 'WARNING', 'CRITICAL')
+CLEAR = (0, 'Syslog clear')
+
+# Used when no --rules file is given. These are the checks check_syslog.pl
+# has always done.
+DEFAULT_RULES = r'''
+OK       | clear | Syslog clear                  | .* rsyslogd: \[.+\] \(re\)start
+OK       | clear | Syslog clear                  | force-syslog-all-clear
+CRITICAL | raise | Device failure, array offline | offlined - array failed
+CRITICAL | raise | nf_conntrack: table full      | nf_conntrack: table full
+'''
+
+# How much of the log we lowercase and search at a time.
+BLOCK_SIZE = 16 * 1024 * 1024
+LOWERCASE = string.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+def main(args):
+    '''This is the body of the plugin. Loads the previous state, scans
+    whatever was appended to the log since then and saves the new state.
+    Returns a value that is appropriate to a Nagios plugin.
+
+    '''
+    parser = OptionParser(prog=os.path.basename(args[0]))
+    parser.add_option('-f', '--file', dest='file', default='/var/log/syslog',
+                      help='Log file to scan.', metavar='FILE')
+    parser.add_option('-s', '--state-file', dest='state_file', metavar='FILE',
+                      help='Where to remember the log position and alert state.')
+    parser.add_option('-r', '--rules', dest='rules', metavar='FILE',
+                      help='Rule file to load instead of the built in rules.')
+    parser.add_option('--clear', dest='clear', action='store_true', default=False,
+                      help='Reset the alert state to OK and exit.')
+    (options, args) = parser.parse_args(args[1:])
+    if not options.state_file:
+        options.state_file = default_state_file(options.file)
+
+    run = Run()
+    state = load_state(options.state_file)
+    if options.clear:
+        state['code'], state['message'] = CLEAR
+        save_state(options.state_file, state)
+        return run.okay(state['message'])
+
+    try:
+        if options.rules:
+            f = open(options.rules)
+            try:
+                rules = parse_rules(f.read(), options.rules)
+            finally:
+                f.close()
+        else:
+            rules = parse_rules(DEFAULT_RULES, 'built in rules')
+    except (IOError, ValueError), e:
+        return run.unknown(str(e))
+    matcher = Matcher(rules)
+    names = set(rule[4] for rule in rules)
+    state['hits'] = dict((name, n) for name, n in state['hits'].items() if name in names)
+
+    try:
+        st = os.stat(options.file)
+    except OSError, e:
+        return run.unknown(str(e))
+
+    if state['inode'] is not None and state['inode'] != st.st_ino:
+        # Rotated: finish whatever was written to the old file after our
+        # last run, then start over at the top of the new one.
+        rotated = find_rotated(options.file, state['inode'])
+        if rotated is not None:
+            with run.phase('scan'):
+                scan(rotated, state['offset'], state, matcher)
+        state['offset'] = 0
+    elif st.st_size < state['offset']:
+        state['offset'] = 0
+
+    state['inode'] = st.st_ino
+    with run.phase('scan'):
+        state['offset'] = scan(options.file, state['offset'], state, matcher)
+    save_state(options.state_file, state)
+
+    return run.emit(state['code'], state['message'],
+                    ["'%s'=%dc" % (name, state['hits'][name]) for name in sorted(state['hits'])])
+
+
+def default_state_file(log):
+    '''Returns the state file to use for log when none is given, e.g.
+    /var/tmp/check_logscan_var_log_syslog.state for /var/log/syslog.
+
+    '''
+    name = os.path.abspath(log).replace('/', '_')
+    return '/var/tmp/check_logscan%s.state' % name
+
+
+def load_state(path):
+    state = {'inode': None, 'offset': 0, 'code': CLEAR[0], 'message': CLEAR[1],
+             'hits': {}}
+    try:
+        f = open(path)
+        try:
+            state.update(json.load(f))
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        pass
+    return state
+
+
+def save_state(path, state):
+    '''Atomically replaces the state file, so an interrupted run never
+    leaves a half written one behind. The temporary name includes the
+    thread, as plugin_scheduler can run several checks in one process.
+
+    '''
+    tmp = '%s.%d.%d' % (path, os.getpid(), thread.get_ident())
+    try:
+        f = open(tmp, 'w')
+        json.dump(state, f)
+        f.close()
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+def find_rotated(path, inode):
+    '''Returns the name of the rotated copy of path that still has the
+    given inode, or None if it is gone.
+
+    '''
+    for candidate in (path + '.1', path + '.0'):
+        try:
+            if os.stat(candidate).st_ino == inode:
+                return candidate
+        except OSError:
+            pass
+    return None
+
+
+def parse_rules(text, source):
+    '''Parses rule file text into a list of (description, code, clear,
+    regex, name) tuples. The name is the description, made unique with a
+    "#2", "#3"... suffix, and is what the hits are counted under. Raises
+    ValueError naming the offending line.
+
+    '''
+    rules, names = [], set()
+    for lineno, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = [x.strip() for x in line.split('|', 3)]
+        if len(fields) != 4:
+            raise ValueError('%s line %d: expected "SEVERITY | clear/raise | '
+                             'description | regex"' % (source, lineno))
+        severity, action, description, pattern = fields
+        if severity.upper() not in STATES:
+            raise ValueError('%s line %d: unknown severity "%s"' % (source, lineno, severity))
+        if action not in ('clear', 'raise'):
+            raise ValueError('%s line %d: action must be clear or raise' % (source, lineno))
+        try:
+            regex = re.compile(pattern, re.I)
+        except re.error, e:
+            raise ValueError('%s line %d: %s' % (source, lineno, e))
+        name, n = description, 1
+        while name in names:
+            n += 1
+            name = '%s #%d' % (description, n)
+        names.add(name)
+        rules.append((description, STATES.index(severity.upper()), action == 'clear', regex, name))
+    return rules
+
+
+def required_literal(pattern):
+    '''Returns a string that every line matching pattern must contain, or
+    None if we can't find one worth searching for. This is the longest run
+    of plain text outside of any group, character class or optional part
+    of the pattern, which is enough for the usual log message rules.
+
+    '''
+    if re.search(r'\(\?[a-zA-Z]*x', pattern):
+        return None  # verbose patterns don't mean what they say
+    runs, run, i = [], [], 0
+    while i < len(pattern):
+        c, literal = pattern[i], False
+        if c == '\\':
+            escape = re.match(r'\\(x[0-9a-fA-F]{2}|[0-7]{2,3}|[0-9]+|.)', pattern[i:], re.S)
+            end = i + len(escape.group(0))
+            c, literal = escape.group(1), not escape.group(1)[0].isalnum()
+        elif c == '[':
+            end = class_end(pattern, i)
+        elif c == '(':
+            end = group_end(pattern, i)
+        elif c == '|':
+            return None
+        else:
+            end, literal = i + 1, c not in '.^$*+?'
+
+        quantifier = re.match(r'([*+?]|\{(\d*),?\d*\})\??', pattern[end:])
+        if quantifier and quantifier.group(1) in ('{}', '{,}'):
+            quantifier = None  # "{}" and "{,}" are plain text
+        if quantifier:
+            end += len(quantifier.group(0))
+        if literal and (not quantifier or quantifier.group(1) == '+' or
+                        int(quantifier.group(2) or 0) > 0):
+            run.append(c)
+        if not literal or quantifier:
+            runs.append(''.join(run))
+            run = []
+        i = end
+    runs.append(''.join(run))
+
+    # Leading and trailing blanks are cut off because a literal that starts
+    # with a common character makes the combined search much slower.
+    literal = max((x.strip() for x in runs), key=len)
+    return literal if len(literal) >= 3 else None
+
+
+def class_end(pattern, i):
+    '''Returns the index just past the character class starting at i.'''
+    i += 1
+    if pattern[i:i + 1] == '^':
+        i += 1
+    if pattern[i:i + 1] == ']':
+        i += 1
+    while pattern[i] != ']':
+        i += 2 if pattern[i] == '\\' else 1
+    return i + 1
+
+
+def group_end(pattern, i):
+    '''Returns the index just past the group starting at i.'''
+    depth = 0
+    while True:
+        if pattern[i] == '\\':
+            i += 2
+            continue
+        if pattern[i] == '[':
+            i = class_end(pattern, i)
+            continue
+        if pattern[i] == '(':
+            depth += 1
+        elif pattern[i] == ')':
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        i += 1
+
+
+class Matcher(object):
+    '''Finds the lines of a block of log data that match any of the rules.
+
+    Rather than trying every rule on every line, the literal text each rule
+    requires is compiled into one combined search that runs over the whole
+    lowercased block, so only the lines containing one of those literals
+    are checked against the rules themselves. Rules without a usable
+    literal get a block wide search of their own. A line found that way is
+    only run through the rules whose literal it contains.
+
+    The combined search can skip ahead quickly only to characters that
+    start one of its alternatives, so each literal is cut down to start at
+    the character that is rarest in the first block of log we see.
+
+    '''
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.literals, self.unfiltered, self.checks = set(), [], []
+        for rule in rules:
+            literal = required_literal(rule[3].pattern)
+            if literal is not None:
+                literal = literal.lower()
+                self.literals.add(literal)
+            else:
+                self.unfiltered.append(re.compile(rule[3].pattern, re.I | re.M))
+            self.checks.append((rule, literal))
+        self.prefilter = None
+
+    def build_prefilter(self, sample):
+        import collections
+        counts = collections.Counter(sample)
+        anchors = set()
+        for literal in self.literals:
+            start = min(range(len(literal) - 2), key=lambda i: counts[literal[i]])
+            anchors.add(literal[start:])
+        self.prefilter = re.compile('|'.join(
+            re.escape(x) for x in sorted(anchors, key=len, reverse=True)))
+
+    def matches(self, block):
+        '''Yields the first rule to match each matching line of block, in
+        the order the lines appear.
+
+        '''
+        starts = set()
+        if self.literals:
+            lowered = block.translate(LOWERCASE)
+            if self.prefilter is None:
+                self.build_prefilter(lowered[:65536])
+            find_lines(self.prefilter, lowered, starts)
+        for regex in self.unfiltered:
+            find_lines(regex, block, starts)
+
+        for start in sorted(starts):
+            end = block.find('\n', start)
+            line = block[start:end] if end >= 0 else block[start:]
+            lowered = line.translate(LOWERCASE)
+            for rule, literal in self.checks:
+                if (literal is None or literal in lowered) and rule[3].search(line):
+                    yield rule
+                    break
+
+
+def find_lines(regex, block, starts):
+    '''Adds the start offset of every line in block that regex matches
+    somewhere to the starts set. A match can run on past the end of the
+    line it starts on (think "\\s+"), so the search carries on from the
+    next line rather than from the end of the match.
+
+    '''
+    pos = 0
+    while True:
+        m = regex.search(block, pos)
+        if m is None:
+            return
+        starts.add(block.rfind('\n', 0, m.start()) + 1)
+        pos = block.find('\n', m.start())
+        if pos < 0:
+            return
+        pos += 1
+
+
+def scan(path, offset, state, matcher):
+    '''Scans the complete lines of path after offset, updating the alert
+    state as we go. Returns the offset just past the last complete line,
+    so a line that is still being written is picked up next time.
+
+    '''
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return offset
+    try:
+        size = os.fstat(f.fileno()).st_size
+        if size <= offset:
+            return offset
+        base = 0
+        try:
+            data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError):
+            f.seek(offset)
+            data = f.read(size - offset)
+            base, offset, size = offset, 0, len(data)
+        end = data.rfind('\n', offset, size) + 1
+        if end > 0:
+            while offset < end:
+                stop = data.find('\n', min(offset + BLOCK_SIZE, end) - 1, end) + 1
+                for rule in matcher.matches(data[offset:stop]):
+                    apply_rule(rule, state)
+                offset = stop
+        else:
+            end = offset
+        if isinstance(data, mmap.mmap):
+            data.close()
+        return base + end
+    finally:
+        f.close()
+
+
+def apply_rule(rule, state):
+    description, code, clear, regex, name = rule
+    state['hits'][name] = state['hits'].get(name, 0) + 1
+    if clear or code > state['code']:
+        state['code'], state['message'] = code, description
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[0:]))
@@ -0,0 +1,330 @@
+#!/usr/bin/python
+
+'''check_redis_repl.py -- a nagios plugin for Redis replication
+
+This is the bigger sibling of check_redis_repl.sh. Rather than checking
+one slave at a time, give it the master of a replication group and it
+will check every slave of that master in one go:
+
+    check_redis_repl.py -H redis-master -p 6379 -w 1048576 -c 10485760
+
+The slaves are found through the master's INFO replication output, and
+the master is then asked again at the same time as all of its slaves, so
+the offsets we compare are read at the same moment. If you would rather
+list the slaves yourself, add them as host[:port] arguments and the
+master and slaves are all queried at once, in a single round:
+
+    check_redis_repl.py -H redis-master redis-a redis-b:6380
+
+For every slave we check that master_link_status is up and compute how
+many bytes it is behind, which is the master's master_repl_offset minus
+the slave's slave_repl_offset. The -w/-c thresholds are in bytes.
+
+We speak the Redis protocol directly instead of running redis-cli, and
+all of the slaves are queried in parallel, so checking a large group
+costs about one round trip. -t is the time allowed for the whole check,
+and -T for any one server.
+
+This script originally from Mark's Nagios Plugins:
+    https://github.com/xb95/nagios-plugins
+
+Copyright (c) 2011 by Bump Technologies, Inc, and authors and
+contributors. Please see the above linked repository for licensing
+information.
+
+'''
+
+import os
+import socket
+import sys
+import threading
+from optparse import OptionParser
+from Queue import Queue, Empty
+
+from plugin_runtime import Run, FetchError
+
+
+class RedisError(Exception):
+    pass
+
+
+class Redis(object):
+    '''A minimal Redis client that speaks enough of the protocol to run a
+    command and read the reply.
+
+    '''
+
+    def __init__(self, host, port, timeout, password=None):
+        self.key = (host, port, password)
+        self.sock = socket.create_connection((host, port), timeout)
+        self.rfile = self.sock.makefile('rb')
+        if password is not None:
+            self.command('AUTH', password)
+
+    def command(self, *args):
+        req = ['*%d\r\n' % len(args)]
+        for arg in args:
+            req.append('$%d\r\n%s\r\n' % (len(arg), arg))
+        self.sock.sendall(''.join(req))
+        return self.read_reply()
+
+    def read_reply(self):
+        line = self.rfile.readline()
+        if not line.endswith('\r\n'):
+            raise RedisError('connection closed')
+        kind, line = line[0], line[1:-2]
+        if kind == '+':
+            return line
+        elif kind == '-':
+            raise RedisError(line)
+        elif kind == ':':
+            return int(line)
+        elif kind == '$':
+            if int(line) < 0:
+                return None
+            data = self.rfile.read(int(line) + 2)
+            if len(data) != int(line) + 2:
+                raise RedisError('connection closed')
+            return data[:-2]
+        elif kind == '*':
+            if int(line) < 0:
+                return None
+            return [self.read_reply() for _ in range(int(line))]
+        raise RedisError('unexpected reply: %r' % (kind + line))
+
+    def close(self):
+        try:
+            self.rfile.close()
+            self.sock.close()
+        except socket.error:
+            pass
+
+
+class Pool(object):
+    '''Keeps idle connections around by host, port and password, so
+    repeated checks against the same server reuse the socket.
+
+    '''
+
+    def __init__(self):
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def get(self, host, port, timeout, password=None):
+        '''Returns a connection and whether it was reused from the pool.'''
+        self.lock.acquire()
+        try:
+            conns = self.idle.get((host, port, password))
+            if conns:
+                conn = conns.pop()
+                conn.sock.settimeout(timeout)
+                return conn, True
+        finally:
+            self.lock.release()
+        return Redis(host, port, timeout, password), False
+
+    def put(self, conn):
+        self.lock.acquire()
+        try:
+            self.idle.setdefault(conn.key, []).append(conn)
+        finally:
+            self.lock.release()
+
+pool = Pool()
+
+
+def main(args):
+    '''This is the body of the plugin. Verifies arguments, gathers the
+    replication state of the master and its slaves and compares the lag
+    to the thresholds. Returns a value that is appropriate to a Nagios
+    plugin.
+
+    '''
+    parser = OptionParser(prog=os.path.basename(args[0]))
+    parser.add_option('-H', '--host', dest='host', default='localhost',
+                      help='Master to connect to.', metavar='HOST')
+    parser.add_option('-p', '--port', dest='port', type='int', default=6379,
+                      help='Port to connect to.', metavar='PORT')
+    parser.add_option('-a', '--password', dest='password', metavar='PASSWORD',
+                      help='Password to AUTH with.')
+    parser.add_option('-w', '--warning', dest='warning', type='int', metavar='BYTES',
+                      help='WARNING if a slave is this many bytes behind.')
+    parser.add_option('-c', '--critical', dest='critical', type='int', metavar='BYTES',
+                      help='CRITICAL if a slave is this many bytes behind.')
+    parser.add_option('-t', '--timeout', dest='timeout', type='float', default=10,
+                      help='Give up on the whole check after this many seconds.',
+                      metavar='SECONDS')
+    parser.add_option('-T', '--server-timeout', dest='server_timeout', type='float',
+                      default=3, help='Give up on one server after this many seconds.',
+                      metavar='SECONDS')
+    parser.add_option('-j', '--parallel', dest='parallel', type='int', default=128,
+                      help='Query at most this many servers at a time.', metavar='N')
+    (options, args) = parser.parse_args(args[1:])
+
+    if options.parallel < 1:
+        parser.error('--parallel must be at least 1.')
+    if options.warning is None:
+        options.warning = options.critical
+    elif options.critical is None:
+        options.critical = options.warning
+    if options.warning is not None and options.warning > options.critical:
+        parser.error('Warning/Critical thresholds appear to be inverted.')
+
+    run = Run(options.timeout)
+    slaves = []
+    for arg in args:
+        host, _, port = arg.partition(':')
+        slaves.append((host, int(port or options.port)))
+    master = (options.host, options.port)
+
+    with run.phase('info'):
+        infos = info_all([master] + slaves, options, run)
+    minfo = infos[master]
+    if isinstance(minfo, Exception):
+        return run.critical('%s:%d failed: %s' % (master[0], master[1], minfo))
+    if minfo.get('role') != 'master':
+        return run.critical('%s:%d is not a master (role:%s)' %
+                            (master[0], master[1], minfo.get('role')))
+
+    if not slaves:
+        slaves = sorted(master_slaves(minfo))
+        if not slaves:
+            return run.critical('%s:%d has no connected slaves' % master)
+        # The master's offset keeps moving, so read it again together with
+        # the slaves' rather than comparing theirs to one from a round ago.
+        with run.phase('info'):
+            infos = info_all([master] + slaves, options, run)
+        minfo = infos[master]
+        if isinstance(minfo, Exception):
+            return run.critical('%s:%d failed: %s' % (master[0], master[1], minfo))
+
+    master_offset = int(minfo.get('master_repl_offset', 0))
+    known = master_slaves(minfo)
+
+    crit, warn, ok, perfdata = [], [], [], []
+    for slave in slaves:
+        name = '%s:%d' % slave
+        info = infos[slave]
+        if isinstance(info, Exception):
+            crit.append('%s failed: %s' % (name, info))
+            continue
+        if info.get('master_link_status') != 'up':
+            crit.append('%s link %s' % (name, info.get('master_link_status', 'unknown')))
+            continue
+
+        offset = info.get('slave_repl_offset')
+        if offset is None:
+            offset = known.get(slave)
+        if offset is None:
+            ok.append('%s up' % name)
+            continue
+        lag = max(master_offset - int(offset), 0)
+        perfdata.append('%s=%dB;%s;%s;0' % (name, lag, threshold(options.warning),
+                                            threshold(options.critical)))
+        if options.critical is not None and lag >= options.critical:
+            crit.append('%s %d bytes behind (>=%d)' % (name, lag, options.critical))
+        elif options.warning is not None and lag >= options.warning:
+            warn.append('%s %d bytes behind (>=%d)' % (name, lag, options.warning))
+        else:
+            ok.append('%s %d bytes behind' % (name, lag))
+
+    if len(crit) > 0:
+        return run.critical(', '.join(crit), perfdata)
+    elif len(warn) > 0:
+        return run.warning(', '.join(warn), perfdata)
+    return run.okay('%d slaves in sync: %s' % (len(ok), ', '.join(ok)), perfdata)
+
+
+def threshold(val):
+    if val is None:
+        return ''
+    return str(val)
+
+
+def info_all(servers, options, run):
+    '''Runs INFO replication against all of the servers in parallel.
+    Returns a dict mapping each (host, port) to its parsed INFO output, or
+    to the exception we got trying to fetch it.
+
+    '''
+    results, queue = {}, Queue()
+    for server in servers:
+        queue.put(server)
+
+    def worker():
+        while True:
+            try:
+                server = queue.get_nowait()
+            except Empty:
+                return
+            results[server] = info(server, options, run)
+
+    threads = []
+    for _ in range(min(options.parallel, len(servers))):
+        thread = threading.Thread(target=worker)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def info(server, options, run):
+    '''Runs INFO replication on one server, within --server-timeout and
+    the time left for the run. A pooled connection the server has since
+    closed (idle timeout, restart) is retried once on a fresh one.
+    Returns the parsed output, or the exception we got.
+
+    '''
+    try:
+        timeout = min(options.server_timeout, run.remaining())
+        conn, reused = pool.get(server[0], server[1], timeout, options.password)
+        try:
+            reply = conn.command('INFO', 'replication')
+        except (socket.error, RedisError, ValueError), e:
+            conn.close()
+            if not reused or isinstance(e, socket.timeout):
+                raise
+            timeout = min(options.server_timeout, run.remaining())
+            conn = Redis(server[0], server[1], timeout, options.password)
+            try:
+                reply = conn.command('INFO', 'replication')
+            except:
+                conn.close()
+                raise
+    except (socket.error, RedisError, ValueError, FetchError), e:
+        return e
+    pool.put(conn)
+
+    ret = {}
+    for line in (reply or '').splitlines():
+        if not line or line.startswith('#') or ':' not in line:
+            continue
+        key, val = line.split(':', 1)
+        ret[key] = val
+    return ret
+
+
+def master_slaves(info):
+    '''Returns a dict mapping (host, port) of every slave the master lists
+    to the replication offset the master last saw from it (or None).
+
+    '''
+    ret = {}
+    for key in info:
+        if not key.startswith('slave') or not key[5:].isdigit():
+            continue
+        val = info[key]
+        if '=' in val:
+            fields = dict(x.split('=', 1) for x in val.split(',') if '=' in x)
+            host, port, offset = fields.get('ip'), fields.get('port'), fields.get('offset')
+        else:
+            # Redis before 2.8: "ip,port,state"
+            host, port, offset = (val.split(',') + [None, None])[:2] + [None]
+        if host and port:
+            ret[(host, int(port))] = offset
+    return ret
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[0:]))
@@ -53,6 +53,22 @@ fall below them) before they fire. Therefore, if you have 5 nodes in
 your cluster and you want to warn if you lose any, set W to 5. "Warn if
 this goes below 5."
 
+The latency numbers Riak gives are for the last 60 seconds, so a single
+reading can easily catch a spike that is already over. To smooth that
+out, you can take several samples over one connection and check an
+aggregate of them instead:
+
+    check_riak.py -H localhost --95th 10,20,15,25 -n 5 -i 6 -A median
+
+This takes 5 samples 6 seconds apart and checks the median of each stat.
+-A can be max (the default, the worst sample), median, or a number N,
+which only alerts if at least N of the samples are over the threshold.
+For --nodes the worst sample is the one with the fewest nodes. The
+samples are started -i seconds apart, however long each one takes. If
+the timeout (-t) runs out before all of them are taken, the ones that
+were taken are checked; with -A N, fewer than N samples are UNKNOWN, as
+we can't tell whether N of them would have been over.
+
 This script originally from Mark's Nagios Plugins:
     https://github.com/xb95/nagios-plugins
 
@@ -62,20 +78,14 @@ information.
 
 '''
 
+import os
 import re
 import sys
-from urllib2 import urlopen, URLError
+import time
 from json import loads
 from optparse import OptionParser
 
-
-def _nagios(hdr, msg, code):
-    print '%s: %s' % (hdr, msg)
-    return code
-
-def critical(msg): return _nagios('CRITICAL', msg, 2)
-def warning(msg): return _nagios('WARNING', msg, 1)
-def okay(msg): return _nagios('OKAY', msg, 0)
+from plugin_runtime import Run, FetchError
 
 
 def main(args):
@@ -84,11 +94,20 @@ def main(args):
     value that is appropriate to a Nagios plugin.
 
     '''
-    parser = OptionParser()
+    parser = OptionParser(prog=os.path.basename(args[0]))
     parser.add_option('-H', '--host', dest='host', default='localhost',
                       help='Host to connect to.', metavar='HOST')
     parser.add_option('-p', '--port', dest='port', type='int', default=8098,
                       help='Port to connect to.', metavar='PORT')
+    parser.add_option('-t', '--timeout', dest='timeout', type='float', default=10,
+                      help='Give up after this many seconds.', metavar='SECONDS')
+    parser.add_option('-n', '--samples', dest='samples', type='int', default=1,
+                      help='How many samples of the stats to take.', metavar='N')
+    parser.add_option('-i', '--interval', dest='interval', type='float', default=5,
+                      help='Seconds between samples.', metavar='SECONDS')
+    parser.add_option('-A', '--aggregate', dest='aggregate', default='max',
+                      help='Check the max, median or N-th worst of the samples.',
+                      metavar='METHOD')
     parser.add_option('--95th', dest='t95', metavar='THRESHOLDS',
                       help='"PW,PC,GW,GC" values for 95th percentile data')
     parser.add_option('--99th', dest='t99', metavar='THRESHOLDS',
@@ -121,7 +140,7 @@ def main(args):
                       help='"W,C" values for median percentile data')
     parser.add_option('--nodes', dest='tnodes', metavar='NODE_THRESHOLDS',
                       help='"W,C" format for connected node thresholds')
-    (options, args) = parser.parse_args()
+    (options, args) = parser.parse_args(args[1:])
 
     types = ('95', '99', '100', 'mean', 'median')
     for optname in types:
@@ -136,18 +155,67 @@ def main(args):
             parser.error('Object size thresholds must be of the format "W,C".')
     if options.tnodes and not re.match(r'^\d+,\d+$', options.tnodes):
         parser.error('Connected node threshold must be of the format "W,C".')
-
-    try:
-        req = urlopen("http://%s:%d/stats" % (options.host, options.port))
-        obj = loads(req.read())
-    except (URLError, ValueError) as e:
-        return critical(str(e))
+    if options.samples < 1:
+        parser.error('--samples must be at least 1.')
+    elif options.interval < 0:
+        parser.error('--interval must be positive.')
+    elif (options.samples - 1) * options.interval >= options.timeout:
+        parser.error('--samples taken --interval apart do not fit in --timeout.')
+    if options.aggregate.isdigit():
+        if not 1 <= int(options.aggregate) <= options.samples:
+            parser.error('--aggregate N must be between 1 and --samples.')
+    elif options.aggregate not in ('max', 'median'):
+        parser.error('Aggregate "%s" not valid.' % options.aggregate)
+
+    # The stats we need to look at, so we only keep those from each sample.
+    wanted = []
+    for ttype in types:
+        if getattr(options, 't%s' % ttype, None) is not None:
+            wanted += ['node_get_fsm_time_%s' % ttype, 'node_put_fsm_time_%s' % ttype]
+    for prefix, stat in (('o', 'objsize'), ('s', 'siblings')):
+        for ttype in types:
+            if getattr(options, '%s%s' % (prefix, ttype), None) is not None:
+                wanted.append('node_get_fsm_%s_%s' % (stat, ttype))
+    if options.tnodes is not None:
+        wanted.append('connected_nodes')
+
+    run = Run(options.timeout)
+    samples = []
+    first = None
+    for i in range(options.samples):
+        if i > 0:
+            # Space the samples by when they start, so a slow fetch doesn't
+            # push the rest back, and stop once the next can't start in time.
+            wait = max(first + i * options.interval - time.time(), 0)
+            if run.deadline is not None and time.time() + wait >= run.deadline:
+                break
+            time.sleep(wait)
+        else:
+            first = time.time()
+        try:
+            with run.phase('fetch'):
+                status, body = run.get(options.host, options.port, '/stats')
+            if status != 200:
+                return run.critical('status = %d when talking to %s:%d' %
+                                    (status, options.host, options.port))
+            samples.append(pick_stats(loads(body), wanted))
+        except (FetchError, ValueError) as e:
+            if samples and run.expired():
+                break
+            return run.critical(str(e))
+    if options.aggregate.isdigit() and len(samples) < int(options.aggregate):
+        return run.unknown('only %d of %d samples fit in the timeout, -A %s needs %s' % (
+            len(samples), options.samples, options.aggregate, options.aggregate))
+    obj = aggregate_stats(samples, options.aggregate)
 
     crit, warn, ok = [], [], []
     def check_ms(metric, warning, critical):
         if metric not in obj:
             crit.append('%s not found in Riak stats output' % metric)
             return
+        if obj[metric] is None:
+            ok.append('%s: in fewer than %s samples' % (metric, options.aggregate))
+            return
         val_ms = int(obj[metric] / 1000)
         if val_ms > critical:
             crit.append('%s: %dms (>%dms)' % (metric, val_ms, critical))
@@ -168,6 +236,9 @@ def main(args):
         if metric not in obj:
             crit.append('%s not found in Riak stats output' % metric)
             return
+        if obj[metric] is None:
+            ok.append('%s: in fewer than %s samples' % (metric, options.aggregate))
+            return
         val = int(obj[metric])
         if val > critical:
             crit.append('%s: %d (>%d)' % (metric, val, critical))
@@ -188,8 +259,10 @@ def main(args):
     val = getattr(options, 'tnodes', None)
     if val is not None:
         rw, rc = [int(x) for x in val.split(',', 2)]
-        if 'connected_nodes' in obj:
-            conn_nodes = len(obj['connected_nodes'])
+        if obj.get('connected_nodes', 0) is None:
+            ok.append('nodes: in fewer than %s samples' % options.aggregate)
+        elif 'connected_nodes' in obj:
+            conn_nodes = obj['connected_nodes']
             if conn_nodes < rc:
                 crit.append('nodes: %d connected (<%d)' % (conn_nodes, rc))
             elif conn_nodes < rw:
@@ -199,11 +272,61 @@ def main(args):
         else:
             crit.append('nodes: unable to determine connected nodes')
 
+    if options.samples > 1:
+        how = '%s of %d samples' % (options.aggregate, len(samples))
+        if len(samples) < options.samples:
+            how += ', %d more did not fit in the timeout' % (options.samples - len(samples))
+        for msgs in (crit, warn, ok):
+            if msgs:
+                msgs[-1] += ' [%s]' % how
+                break
+
     if len(crit) > 0:
-        return critical(', '.join(crit))
+        return run.critical(', '.join(crit))
     elif len(warn) > 0:
-        return warning(', '.join(warn))
-    return okay(', '.join(ok))
+        return run.warning(', '.join(warn))
+    return run.okay(', '.join(ok))
+
+
+def pick_stats(stats, wanted):
+    '''Returns just the wanted stats out of one /stats response, with the
+    list of connected nodes turned into a count. Riak has no way to ask
+    for only some of the stats, so this is the best we can do to keep a
+    run with many samples small.
+
+    '''
+    ret = {}
+    for key in wanted:
+        if key in stats:
+            if key == 'connected_nodes':
+                ret[key] = len(stats[key])
+            else:
+                ret[key] = stats[key]
+    return ret
+
+
+def aggregate_stats(samples, method):
+    '''Combines the samples into one dict of stats. For each stat we take
+    the worst value (max), the median, or the N-th worst value, which is
+    over a threshold exactly when at least N of the samples are. A stat
+    found in fewer than N samples can't be, and is set to None. Fewer
+    connected nodes is worse, for everything else a bigger value is.
+
+    '''
+    ret = {}
+    for key in set(k for sample in samples for k in sample):
+        values = sorted(sample[key] for sample in samples if key in sample)
+        if key != 'connected_nodes':
+            values.reverse()
+        if method == 'max':
+            ret[key] = values[0]
+        elif method == 'median':
+            ret[key] = (values[(len(values) - 1) // 2] + values[len(values) // 2]) / 2.0
+        elif len(values) < int(method):
+            ret[key] = None
+        else:
+            ret[key] = values[int(method) - 1]
+    return ret
 
 
 if __name__ == '__main__':
@@ -13,27 +13,22 @@ that the ring is entirely consistent.
 Usage:
     ./check_riak_ring.py [-p 8098] [--down-ok] hosta hostb hostc hostd...
 
+-t is the time allowed for the whole ring, and -T for any one node. If
+the whole ring can't be checked in time we go CRITICAL, even with
+--down-ok, rather than report on the part of the ring we got to.
+
 Copyright (c) 2012 by Bump Technologies, Inc, and authors and
 contributors. Please see the above linked repository for licensing
 information.
 
 '''
 
-import random
-import re
+import os
 import sys
-from urllib2 import urlopen, URLError
 from json import loads
 from optparse import OptionParser
 
-
-def _nagios(hdr, msg, code):
-    print '%s: %s' % (hdr, msg)
-    return code
-
-def critical(msg): return _nagios('CRITICAL', msg, 2)
-def warning(msg): return _nagios('WARNING', msg, 1)
-def okay(msg): return _nagios('OKAY', msg, 0)
+from plugin_runtime import Run, FetchError
 
 
 def main(args):
@@ -42,43 +37,52 @@ def main(args):
     value that is appropriate to a Nagios plugin.
 
     '''
-    parser = OptionParser()
+    parser = OptionParser(prog=os.path.basename(args[0]))
     parser.add_option('-p', '--port', dest='port', type='int', default=8098,
                       help='Port to connect to.', metavar='PORT')
     parser.add_option('--down-ok', dest='down_ok', action='store_true',
                       help='Do not alert on down nodes.')
     parser.add_option('-v', dest='verbose', action='store_true',
                       help='Print extra data in the output.')
-    parser.add_option('-t', '--timeout', dest='timeout', type='int', default=3,
-                      help='Connection timeout.')
-    (options, args) = parser.parse_args()
+    parser.add_option('-t', '--timeout', dest='timeout', type='float', default=10,
+                      help='Give up on the whole ring after this many seconds.')
+    parser.add_option('-T', '--node-timeout', dest='node_timeout', type='float', default=3,
+                      help='Give up on one node after this many seconds.')
+    (options, args) = parser.parse_args(args[1:])
 
     # Ensure we have hosts
     if not args:
-        print 'Usage: ./check_riak_ring.py [-v] [-p 8098] [-t 3] [--down-ok] <hosta> [hostb hostc...]'
+        print 'Usage: ./check_riak_ring.py [-v] [-p 8098] [-t 10] [-T 3] [--down-ok] <hosta> [hostb hostc...]'
         sys.exit(1)
 
     # Gather ring states by iterating over the list of nodes we were told to
     # connect to, but also accepting more to add to our list.
+    run = Run(options.timeout)
     ownership, ownstrings = {}, {}
     hosts = args
     while len(hosts) > 0:
         host = hosts.pop(0)
         try:
-            req = urlopen("http://%s:%d/stats" % (host, options.port), timeout=options.timeout)
-            obj = loads(req.read())
-        except (URLError, ValueError) as e:
+            with run.phase('fetch'):
+                status, body = run.get(host, options.port, '/stats', options.node_timeout)
+            obj = None
+            if status == 200:
+                obj = loads(body)
+        except (FetchError, ValueError) as e:
+            if run.expired():
+                return run.critical('timed out with %d nodes left to check: %s' %
+                                    (len(hosts) + 1, ', '.join([host] + hosts)))
             if options.down_ok:
                 continue
-            return critical('%s failed (GET): %s' % (host, str(e)))
+            return run.critical('%s failed (GET): %s' % (host, str(e)))
         if obj is None or 'ring_ownership' not in obj:
             if options.down_ok:
                 continue
-            return critical('%s failed: no stats found' % host)
+            return run.critical('%s failed: no stats found' % host)
 
         owned = parse_ownership(obj['ring_ownership'])
         if not len(owned):
-            return critical('%s has no connected nodes' % host)
+            return run.critical('%s has no connected nodes' % host)
 
         ownstring = ''
         for thost in sorted(owned):
@@ -97,9 +101,9 @@ def main(args):
     # ownstrings dict is only length one, we're good.
     if len(ownstrings) == 1:
         if options.verbose:
-            return okay('%d nodes agree: %s' % (len(ownership), ' '.join(sorted(ownership))))
+            return run.okay('%d nodes agree: %s' % (len(ownership), ' '.join(sorted(ownership))))
         else:
-            return okay('%d nodes up: ring is in agreement' % len(ownership))
+            return run.okay('%d nodes up: ring is in agreement' % len(ownership))
 
     # Something has gone badly wrong. Let's see if we can identify the most
     # common pattern, and then reverse that to figure out who disagrees with
@@ -113,7 +117,7 @@ def main(args):
     for host in ownership:
         if ownership[host] != prob_correct:
             bad_hosts.append(host)
-    return critical('Ring ownership disagreement! Maybe check: %s' %
+    return run.critical('Ring ownership disagreement! Maybe check: %s' %
                     ', '.join(sorted(bad_hosts)))
 
 
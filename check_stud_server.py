@@ -0,0 +1,235 @@
+#!/usr/bin/python
+
+'''check_stud_server.py -- a nagios plugin for TLS endpoints
+
+This is the bigger sibling of check_stud_server.sh. Give it any number
+of host[:port] endpoints and it will do a TLS handshake with each of
+them, several at a time, and check that the certificate verifies and is
+not about to expire:
+
+    check_stud_server.py -w 30 -c 7 lb01:443 lb02:443 lb03:8443
+
+-w and -c are the number of days a certificate must still be valid for,
+below which we go WARNING or CRITICAL. An endpoint that can't be reached
+or whose certificate doesn't verify is CRITICAL. Certificates are
+verified against the system CA store, or against --ca-file if you sign
+your own. Endpoints can also be read from a file (one per line) with -f.
+IPv6 addresses are given in brackets, like [2001:db8::1]:443. -t is the
+time allowed for the whole check, and -T for any one endpoint; endpoints
+we didn't get to in time are CRITICAL.
+
+Everything is rolled up into one status line. The perfdata has the
+slowest connect and handshake times and the fewest days left on any
+certificate; use -v to also get one line per endpoint.
+
+This script originally from Mark's Nagios Plugins:
+    https://github.com/xb95/nagios-plugins
+
+Copyright (c) 2011 by Bump Technologies, Inc, and authors and
+contributors. Please see the above linked repository for licensing
+information.
+
+'''
+
+import os
+import socket
+import ssl
+import sys
+import threading
+import time
+from optparse import OptionParser
+from Queue import Queue, Empty
+
+from plugin_runtime import Run, FetchError
+
+
+def main(args):
+    '''This is the body of the plugin. Verifies arguments, checks all of
+    the endpoints and rolls the results up. Returns a value that is
+    appropriate to a Nagios plugin.
+
+    '''
+    parser = OptionParser(prog=os.path.basename(args[0]))
+    parser.add_option('-w', '--warning', dest='warning', type='int', default=30,
+                      help='WARNING if a certificate expires within DAYS.', metavar='DAYS')
+    parser.add_option('-c', '--critical', dest='critical', type='int', default=7,
+                      help='CRITICAL if a certificate expires within DAYS.', metavar='DAYS')
+    parser.add_option('-f', '--file', dest='file', metavar='FILE',
+                      help='Read endpoints from FILE, one per line.')
+    parser.add_option('-p', '--port', dest='port', type='int', default=443,
+                      help='Port for endpoints given without one.', metavar='PORT')
+    parser.add_option('-t', '--timeout', dest='timeout', type='float', default=30,
+                      help='Give up on the whole check after this many seconds.',
+                      metavar='SECONDS')
+    parser.add_option('-T', '--endpoint-timeout', dest='endpoint_timeout', type='float',
+                      default=5, help='Connect and handshake timeout for one endpoint.',
+                      metavar='SECONDS')
+    parser.add_option('-j', '--parallel', dest='parallel', type='int', default=32,
+                      help='Check at most this many endpoints at a time.', metavar='N')
+    parser.add_option('--ca-file', dest='ca_file', metavar='FILE',
+                      help='Verify certificates against these CAs.')
+    parser.add_option('--no-check-hostname', dest='check_hostname', default=True,
+                      action='store_false', help='Do not match the certificate to the host name.')
+    parser.add_option('-v', dest='verbose', action='store_true',
+                      help='Print a line per endpoint.')
+    (options, args) = parser.parse_args(args[1:])
+
+    run = Run(options.timeout)
+    if options.file:
+        try:
+            f = open(options.file)
+            try:
+                args += [x.strip() for x in f if x.strip() and not x.startswith('#')]
+            finally:
+                f.close()
+        except IOError, e:
+            return run.unknown(str(e))
+    if not args:
+        parser.error('You must give at least one endpoint.')
+    if options.parallel < 1:
+        parser.error('--parallel must be at least 1.')
+    if options.warning < options.critical:
+        parser.error('Warning/Critical thresholds appear to be inverted.')
+
+    endpoints = [parse_endpoint(arg, options.port) for arg in args]
+
+    context = ssl.create_default_context(cafile=options.ca_file)
+    context.check_hostname = options.check_hostname
+    with run.phase('check'):
+        results = check_all(endpoints, context, options, run)
+
+    crit, warn, details = [], [], []
+    soonest = None
+    for endpoint in endpoints:
+        name = endpoint_name(endpoint)
+        res = results[endpoint]
+        if 'error' in res:
+            crit.append('%s %s' % (name, res['error']))
+            details.append('%s: %s' % (name, res['error']))
+            continue
+        if soonest is None or res['days'] < soonest[1]:
+            soonest = (name, res['days'])
+        if res['days'] < options.critical:
+            crit.append('%s expires in %d days' % (name, res['days']))
+        elif res['days'] < options.warning:
+            warn.append('%s expires in %d days' % (name, res['days']))
+        details.append('%s: %s, %d days left, connect %.3fs, handshake %.3fs' % (
+            name, res['version'], res['days'], res['connect'], res['handshake']))
+
+    good = [r for r in results.values() if 'error' not in r]
+    perfdata = ['failed=%d;;1;0;%d' % (len(endpoints) - len(good), len(endpoints))]
+    if good:
+        perfdata += [
+            'connect_max=%.6fs' % max(r['connect'] for r in good),
+            'handshake_max=%.6fs' % max(r['handshake'] for r in good),
+            'handshake_avg=%.6fs' % (sum(r['handshake'] for r in good) / len(good)),
+            'days_min=%d;%d:;%d:' % (soonest[1], options.warning, options.critical),
+        ]
+    if not options.verbose:
+        details = None
+
+    if len(crit) > 0:
+        return run.critical(', '.join(crit), perfdata, details)
+    elif len(warn) > 0:
+        return run.warning(', '.join(warn), perfdata, details)
+    return run.okay('%d endpoints ok, soonest expiry %s in %d days' % (
+        len(endpoints), soonest[0], soonest[1]), perfdata, details)
+
+
+def parse_endpoint(arg, default_port):
+    '''Splits "host", "host:port", "[v6addr]" or "[v6addr]:port" into
+    (host, port). A bare IPv6 address, with more than one colon and no
+    brackets, is taken to have no port.
+
+    '''
+    if arg.startswith('['):
+        host, _, rest = arg[1:].partition(']')
+        port = rest[1:] if rest.startswith(':') else ''
+    elif arg.count(':') == 1:
+        host, _, port = arg.partition(':')
+    else:
+        host, port = arg, ''
+    if not port.isdigit():
+        port = default_port
+    return host, int(port)
+
+
+def endpoint_name(endpoint):
+    if ':' in endpoint[0]:
+        return '[%s]:%d' % endpoint
+    return '%s:%d' % endpoint
+
+
+def check_all(endpoints, context, options, run):
+    '''Checks the endpoints with up to options.parallel of them in flight
+    at a time, each within --endpoint-timeout and the time left for the
+    run. Returns a dict mapping each endpoint to its result.
+
+    '''
+    results, queue = {}, Queue()
+    for endpoint in endpoints:
+        queue.put(endpoint)
+
+    def worker():
+        while True:
+            try:
+                endpoint = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                timeout = min(options.endpoint_timeout, run.remaining())
+            except FetchError:
+                results[endpoint] = {'error': 'not checked, out of time'}
+                continue
+            results[endpoint] = check_endpoint(endpoint, context, timeout)
+
+    threads = []
+    for _ in range(min(options.parallel, len(endpoints))):
+        thread = threading.Thread(target=worker)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def check_endpoint(endpoint, context, timeout):
+    '''Connects to one endpoint and does a TLS handshake. Returns a dict
+    with the connect and handshake times in seconds, the negotiated
+    protocol and the days left on the certificate, or with just an error.
+
+    '''
+    start = time.time()
+    try:
+        sock = socket.create_connection(endpoint, timeout)
+    except socket.error, e:
+        return {'error': 'connect failed: %s' % e}
+    connected = time.time()
+    try:
+        try:
+            tls = context.wrap_socket(sock, server_hostname=endpoint[0])
+        except ssl.CertificateError, e:
+            return {'error': str(e)}
+        except (ssl.SSLError, socket.error), e:
+            return {'error': 'handshake failed: %s' % e}
+        handshaken = time.time()
+        cert = tls.getpeercert()
+        version = tls.version()
+        tls.close()
+    finally:
+        sock.close()
+
+    try:
+        expires = ssl.cert_time_to_seconds(cert['notAfter'])
+    except (KeyError, ValueError):
+        return {'error': 'certificate has no usable notAfter'}
+    return {
+        'connect': connected - start,
+        'handshake': handshaken - connected,
+        'version': version,
+        'days': int((expires - time.time()) // 86400),
+    }
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[0:]))
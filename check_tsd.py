@@ -22,6 +22,24 @@ the line:
 
 $ check_tsd.py -P 20 -m proc.loadavg.15min -t host=web01 -w 5 -c 10
 
+Counters are checked as rates with -r. We fetch the raw counters from
+TSD and turn them into per second rates ourselves. A counter that goes
+down is taken to have been reset to 0, unless you give --counter-max, in
+which case it is taken to have wrapped around at that value. That only
+works on each counter on its own, so a rate check groups on every tag and
+does the aggregation (-a) and downsampling (-D) itself. TSD can't group
+on tags it isn't told about, so give -g for every tag key the metric's
+series have besides those given with -t (just host if you give none):
+
+$ check_tsd.py -r -m net.stat.tcp.retransmit -g host -g type -w 100
+
+A plain check can be given -g as well, in which case it also fetches
+every series and aggregates them itself. The point of that is caching:
+when the checks are run from plugin_scheduler.py, --cache-ttl lets checks
+that make the same query within that many seconds share one fetch, and
+a plain and a rate check of the same metric make the same query when
+they have the same -t, -g and -d. Checks with different ones don't share.
+
 There are many more options. I recommend you read through them to get an
 idea of what they can do.
 
@@ -35,20 +53,33 @@ licensing information.
 '''
 
 
-import datetime
-import httplib
 import operator
-import socket
+import os
 import sys
 import time
 from optparse import OptionParser
 
+from plugin_runtime import Run, FetchError
+
+
+# Parsed query results by (host, port, url), shared by every check run in
+# this process. Only used with --cache-ttl.
+cache = {}
+
+
+def average(values):
+    return float(sum(values)) / len(values)
+
+# What -a and -D do to the values of a rate check, which TSD can't do for
+# us since it only sees the counters.
+AGGREGATORS = {'avg': average, 'min': min, 'sum': sum, 'max': max}
+
 
 def main(argv):
     '''Main program runs here. Get the arguments, do something interesting.
 
     '''
-    parser = OptionParser(usage=__doc__)
+    parser = OptionParser(usage=__doc__, prog=os.path.basename(argv[0]))
     parser.add_option('-H', '--host', dest='host', default='localhost', metavar='HOST',
             help='Hostname to use to connect to the TSD.')
     parser.add_option('-p', '--port', dest='port', type='int', default=4242,
@@ -57,6 +88,13 @@ def main(argv):
             help='Metric to query.')
     parser.add_option('-r', '--rate', dest='rate', default=False, action='store_true',
             help='Parse metric as a rate value.')
+    parser.add_option('-g', '--group-by', dest='group_by', action='append', default=[],
+            metavar='TAGK', help='Tag key that tells the series apart (default'
+            ' host for -r, none otherwise).')
+    parser.add_option('--counter-max', dest='counter_max', type='int',
+            metavar='VALUE', help='Value at which the counter wraps around (for -r).')
+    parser.add_option('--cache-ttl', dest='cache_ttl', type='int', default=0,
+            metavar='SECONDS', help='Reuse query results this many seconds old.')
     parser.add_option('-L', '--delta', dest='delta', default=False, action='store_true',
             help='Use delta mode (see docs)')
     parser.add_option('-t', '--tag', dest='tags', action='append', default=[],
@@ -126,8 +164,14 @@ def main(argv):
         parser.error('--delta must not be combined with --percent-over')
     elif options.delta and options.buckets_ago > 0:
         parser.error('--delta must not be combined with --buckets-ago')
+    elif options.counter_max is not None and options.counter_max <= 0:
+        parser.error('--counter-max must be strictly positive.')
+    elif options.cache_ttl < 0:
+        parser.error('--cache-ttl must be positive.')
 
     options.percent_over /= 100.0  # Convert to range 0-1
+    if options.rate and not options.group_by:
+        options.group_by = ['host']
     if not options.critical:
         options.critical = options.warning
     elif not options.warning:
@@ -139,29 +183,126 @@ def main(argv):
         parser.error('Warning/Critical thresholds appear to be inverted.')
 
     # Branching logic begins here
+    run = Run(options.timeout)
     if options.bucket_size > 0:
-        return bucket_check(options, comparator)
+        return bucket_check(run, options, comparator)
     else:
-        return recent_check(options, comparator)
+        return recent_check(run, options, comparator)
+
+
+def counter_delta(old, new, counter_max=None):
+    '''Returns how much a counter went up between two readings. If it went
+    down, it either wrapped around at counter_max or, if we don't know
+    where it wraps, was reset. We don't know when a reset happened, so
+    let's just assume it restarted from 0. Not a great solution, but it
+    should keep the data away from crazytown.
+
+    '''
+    if new >= old:
+        return new - old
+    if counter_max is not None and old <= counter_max:
+        return counter_max - old + new
+    return new
+
+
+def compute_rates(datapoints, counter_max=None):
+    '''Turns one series of counter readings, sorted by time, into per
+    second rates. Like TSD, each rate is given the timestamp of the later
+    of the two readings it was computed from.
+
+    '''
+    ret = []
+    prev = None
+    for ts, val in datapoints:
+        if prev is not None and ts > prev[0]:
+            ret.append((ts, float(counter_delta(prev[1], val, counter_max)) / (ts - prev[0])))
+        prev = (ts, val)
+    return ret
+
+
+def counter_increase(datapoints, start, end, counter_max=None):
+    '''Returns how much the counter went up between start and end, or None
+    if the series doesn't reach back to start and forward to end. Each
+    pair of readings contributes the part of its increase that falls in
+    the window, assuming the counter went up evenly in between.
+
+    '''
+    if not datapoints or datapoints[0][0] > start or datapoints[-1][0] < end:
+        return None
+    total = 0.0
+    for (ts0, val0), (ts1, val1) in zip(datapoints, datapoints[1:]):
+        overlap = min(ts1, end) - max(ts0, start)
+        if ts1 > ts0 and overlap > 0:
+            total += counter_delta(val0, val1, counter_max) * float(overlap) / (ts1 - ts0)
+    return total
+
+
+def downsample(datapoints, interval, method):
+    '''Downsamples one series the way TSD does: the data points are cut
+    into runs of interval seconds, starting at the first one, and each run
+    becomes one data point at its average timestamp.
+
+    '''
+    func = AGGREGATORS[method]
+    ret = []
+    i = 0
+    while i < len(datapoints):
+        end = datapoints[i][0] + interval
+        window = []
+        while i < len(datapoints) and datapoints[i][0] < end:
+            window.append(datapoints[i])
+            i += 1
+        ret.append((sum(ts for ts, val in window) // len(window),
+                    func([val for ts, val in window])))
+    return ret
+
+
+def aggregate_series(series, method):
+    '''Merges several sorted series into one the way TSD does. At every
+    timestamp any of them has, each series that covers that time adds its
+    value, interpolated linearly between its own data points if need be,
+    and method combines the values.
+
+    '''
+    func = AGGREGATORS[method]
+    timestamps = sorted(set(ts for datapoints in series for ts, val in datapoints))
+    pos = [0] * len(series)
+    ret = []
+    for ts in timestamps:
+        values = []
+        for i, datapoints in enumerate(series):
+            if not datapoints or ts < datapoints[0][0] or ts > datapoints[-1][0]:
+                continue
+            j = pos[i]
+            while datapoints[j][0] < ts:
+                j += 1
+            pos[i] = j
+            ts1, val1 = datapoints[j]
+            if ts1 == ts:
+                values.append(val1)
+            else:
+                ts0, val0 = datapoints[j - 1]
+                values.append(val0 + (val1 - val0) * float(ts - ts0) / (ts1 - ts0))
+        ret.append((ts, func(values)))
+    return ret
 
 
-def linear_fit(dps, dpe, ts):
-    '''Given two data points around a time, return a value for the exact
-    time requested. This is a linear approximation algorithm. Nothing
-    fancy.
+def query_tags(options):
+    '''Returns the tags part of the query. With --group-by, which a rate
+    check always has, it also groups on every one of those tag keys, so
+    that each counter comes back as a series of its own.
 
     '''
-    # If the end value is less than the beginning value, then we assume we had
-    # a counter reset in the middle of the series. Since we don't know where
-    # it reset, let's just assume 0. Not a great solution, but it should keep
-    # the data away from crazytown.
-    if dpe[1] < dps[1]:
-        return 0
-    delta = (float(dpe[1] - dps[1]) / float(dpe[0] - dps[0]))
-    return dps[1] + delta * (ts - dps[0])
+    tags = list(options.tags)
+    if options.group_by:
+        given = set(tag.split('=', 1)[0] for tag in tags)
+        tags += ['%s=*' % tagk for tagk in options.group_by if tagk not in given]
+    if not tags:
+        return ''
+    return '{' + ','.join(tags) + '}'
 
 
-def get_bucket(options, metric, which):
+def get_bucket(run, options, metric, which):
     '''Get the value for a single bucket. This returns a single value
     which is calculated based on the options. The which argument is
     basically how many buckets ago you want, we use 0 to mean the
@@ -178,50 +319,35 @@ def get_bucket(options, metric, which):
         print 'get_bucket size=%d which=%d now=%d start=%d end=%d' % (
               bs, which, now, start, end)
 
+    if not options.rate:
+        print 'sorry, buckets only work with rates right now'
+        sys.exit(1)
+
     url = ('/q?start=%d&end=%d&m=%s&ascii&nagios' %
            (start - bs, end + bs, metric))
-    datapoints = get_datapoints(options, url)
-
-    dp = [None, None, None, None]
-    highest_val = None
-    for datapoint in datapoints:
-        ts, val = datapoint
-
-        if highest_val is None or val > highest_val:
-            highest_val = val
-
-        if ts < start:
-            if dp[0] is None or ts > dp[0][0]:
-                dp[0] = datapoint
-        elif ts > end:
-            if dp[3] is None or ts < dp[3][0]:
-                dp[3] = datapoint
+    # A series that only covers part of the bucket, like one for a host
+    # that came or went in the meantime, counts for the part it covers.
+    increases, framed, partial = [], 0, 0
+    for datapoints in get_series(run, options, url):
+        increase = counter_increase(datapoints, start, end, options.counter_max)
+        if increase is not None:
+            framed += 1
         else:
-            if dp[1] is None or ts < dp[1][0]:
-                dp[1] = datapoint
-            if dp[2] is None or ts > dp[2][0]:
-                dp[2] = datapoint
-
-    if dp[0] is None or dp[1] is None or dp[2] is None or dp[3] is None:
+            first, last = max(start, datapoints[0][0]), min(end, datapoints[-1][0])
+            if first >= last:
+                continue
+            increase = counter_increase(datapoints, first, last, options.counter_max)
+            partial += 1
+        increases.append(increase)
+    if options.verbose:
+        print 'get_bucket series: %d framed, %d partial' % (framed, partial)
+    if not framed:
         print 'not enough data to frame the requested bucket'
         sys.exit(1)
-    start_val = linear_fit(dp[0], dp[1], start)
-    end_val = linear_fit(dp[2], dp[3], end)
-
-    if options.rate:
-        # If the counter restarted in the middle of this bucket, we have to do
-        # some work to make sure our value is mostly correct. This is a best
-        # effort approximation.
-        if end_val < start_val:
-            return (highest_val - start_val) + end_val
-        else:
-            return end_val - start_val
-    else:
-        print 'sorry, buckets only work with rates right now'
-        sys.exit(1)
+    return AGGREGATORS[options.aggregator](increases)
 
 
-def bucket_check(options, comparator):
+def bucket_check(run, options, comparator):
     '''A bucket check is a comparison of buckets. A bucket is defined as
     a sum of data in a certain period of time. We check the most recent
     full bucket against a second bucket located N buckets ago.
@@ -238,9 +364,10 @@ def bucket_check(options, comparator):
         print 'downsampling not supported with bucket checks'
         sys.exit(1)
     metric = '%s:%s%s' % (options.aggregator, options.metric, tags)
+    query = 'sum:%s%s' % (options.metric, query_tags(options))
 
-    b_now = get_bucket(options, metric, 0)
-    b_old = get_bucket(options, metric, options.buckets_ago)
+    b_now = get_bucket(run, options, query, 0)
+    b_old = get_bucket(run, options, query, options.buckets_ago)
     change = ((float(b_now) / b_old) - 1) * 100
     if options.bucket_abs:
         cchange = abs(change)
@@ -251,19 +378,16 @@ def bucket_check(options, comparator):
 
     tmetric = metric.replace('|',':')
     if comparator(cchange, options.critical):
-        print ('CRITICAL: %s %s %s: bucket changed %.2f%%'
-               % (tmetric, options.comparator, options.critical, change))
-        return 2
+        return run.critical('%s %s %s: bucket changed %.2f%%'
+                            % (tmetric, options.comparator, options.critical, change))
     elif comparator(cchange, options.warning):
-        print ('WARNING: %s %s %s: bucket changed %.2f%%'
-               % (tmetric, options.comparator, options.warning, change))
-        return 1
+        return run.warning('%s %s %s: bucket changed %.2f%%'
+                           % (tmetric, options.comparator, options.warning, change))
     else:
-        print 'OK: %s: bucket changed %.2f%%' % (tmetric, change)
-        return 0
+        return run.okay('%s: bucket changed %.2f%%' % (tmetric, change))
 
 
-def recent_check(options, comparator):
+def recent_check(run, options, comparator):
     '''A recent check looks only at the recent data (as specified in the
     options) and alerts based on that data.
 
@@ -271,24 +395,28 @@ def recent_check(options, comparator):
     tags = ','.join(options.tags)
     if tags:
         tags = '{' + tags + '}'
-    if options.rate:
-        options.metric = 'rate:' + options.metric
     if options.downsample == 'none':
         downsampling = ''
     else:
         downsampling = ':%ds-%s' % (options.duration, options.downsample)
-    metric = '%s%s:%s%s' % (options.aggregator, downsampling, options.metric,
-                            tags)
-    url = ('/q?start=%ss-ago&m=%s&ascii&nagios' % (options.duration, metric))
-    datapoints = get_datapoints(options, url)
+    if options.rate:
+        metric = '%s%s:rate:%s%s' % (options.aggregator, downsampling,
+                                     options.metric, tags)
+    else:
+        metric = '%s%s:%s%s' % (options.aggregator, downsampling,
+                                options.metric, tags)
+    if options.group_by:
+        query = 'sum:%s%s' % (options.metric, query_tags(options))
+    else:
+        query = metric
+    url = ('/q?start=%ss-ago&m=%s&ascii&nagios' % (options.duration, query))
+    datapoints = get_datapoints(run, options, url)
 
     def no_data_point():
         if options.no_result_ok:
-            print 'OK: query did not return any data point (--no-result-ok)'
-            return 0
+            return run.okay('query did not return any data point (--no-result-ok)')
         else:
-            print 'CRITICAL: query did not return any data point'
-            return 2
+            return run.critical('query did not return any data point')
 
     if not len(datapoints):
         return no_data_point()
@@ -349,24 +477,19 @@ def recent_check(options, comparator):
     if options.delta:
         if newest[0] is None or oldest[0] is None:
             if options.no_result_ok:
-                print 'OK: not enough data to compute the delta'
-                return 0
+                return run.okay('not enough data to compute the delta')
             else:
-                print 'CRITICAL: not enough data to compute the delta'
-                return 2
+                return run.critical('not enough data to compute the delta')
         delta = newest[1] - oldest[1]
         if comparator(delta, options.critical):
-            print 'CRITICAL: %s delta is %s %s: currently %d over %d seconds' % (
-                tmetric, options.comparator, options.critical, delta, options.duration)
-            return 2
+            return run.critical('%s delta is %s %s: currently %d over %d seconds' % (
+                tmetric, options.comparator, options.critical, delta, options.duration))
         elif comparator(delta, options.warning):
-            print 'WARNING: %s delta is %s %s: currently %d over %d seconds' % (
-                tmetric, options.comparator, options.warning, delta, options.duration)
-            return 1
+            return run.warning('%s delta is %s %s: currently %d over %d seconds' % (
+                tmetric, options.comparator, options.warning, delta, options.duration))
         else:
-            print 'OK: %s delta is currently %d over %d seconds' % (tmetric,
-                delta, options.duration)
-            return 0
+            return run.okay('%s delta is currently %d over %d seconds' % (tmetric,
+                delta, options.duration))
 
     # Determine return value.  We have to add the number of critical points
     # to the warning points because the criticals may not cross the
@@ -383,60 +506,75 @@ def recent_check(options, comparator):
     # In nrpe, pipe character is something special, but it's used in tag
     # searches.  Translate it to something else for the purposes of output.
     if not rv:
-        print ('OK: %s: %d values OK, last=%r' % (tmetric, npoints, val))
-    else:
-        if rv == 1:
-            level ='WARNING'
-            threshold = options.warning
-        elif rv == 2:
-            level = 'CRITICAL'
-            threshold = options.critical
-        print ('%s: %s %s %s: %d/%d bad values (%.1f%%) worst: %r @ %s'
-               % (level, tmetric, options.comparator, threshold,
-                  nbad, npoints, nbad * 100.0 / npoints, bad[1],
-                  time.asctime(time.localtime(bad[0]))))
-    return rv
-
-
-def get_datapoints(options, url):
-    '''Connect to TSD and get data. If a fatal error is encountered,
-    this will call sys.exit automatically with a proper Nagios code.
+        return run.okay('%s: %d values OK, last=%r' % (tmetric, npoints, val))
+    if rv == 1:
+        threshold = options.warning
+    elif rv == 2:
+        threshold = options.critical
+    return run.emit(rv, '%s %s %s: %d/%d bad values (%.1f%%) worst: %r @ %s'
+                    % (tmetric, options.comparator, threshold,
+                       nbad, npoints, nbad * 100.0 / npoints, bad[1],
+                       time.asctime(time.localtime(bad[0]))))
+
+
+def get_datapoints(run, options, url):
+    '''Get the data points of every series the query returns. With
+    --group-by, each series is turned into rates (for a rate check) and
+    downsampled on its own first, and then the series are aggregated into
+    one, which is what TSD does for us otherwise.
 
     '''
-    tsd = '%s:%d' % (options.host, options.port)
-    if sys.version_info[0] * 10 + sys.version_info[1] >= 26:  # Python >2.6
-        conn = httplib.HTTPConnection(tsd, timeout=options.timeout)
-    else:  # Python 2.5 or less, using the timeout kwarg will make it croak :(
-        conn = httplib.HTTPConnection(tsd)
-    try:
-        conn.connect()
-    except socket.error, e:
-        print 'ERROR: couldn\'t connect to %s: %s' % (tsd, e)
-        sys.exit(2)
+    series = get_series(run, options, url)
+    if not options.group_by:
+        ret = []
+        for datapoints in series:
+            ret.extend(datapoints)
+        return ret
+
+    ret = []
+    for datapoints in series:
+        if options.rate:
+            datapoints = compute_rates(datapoints, options.counter_max)
+        if options.downsample != 'none':
+            datapoints = downsample(datapoints, options.duration, options.downsample)
+        ret.append(datapoints)
     if options.verbose:
-        print 'Connected to %s:%d' % conn.sock.getpeername()
-        conn.set_debuglevel(1)
+        print 'aggregating %d series with %s' % (len(ret), options.aggregator)
+    return aggregate_series(ret, options.aggregator)
+
+
+def get_series(run, options, url):
+    '''Connect to TSD and get data. Returns a list with the sorted data
+    points of each series in the result. If a fatal error is encountered,
+    this will call sys.exit automatically with a proper Nagios code.
+
+    '''
+    key = (options.host, options.port, url)
+    if options.cache_ttl > 0 and key in cache:
+        fetched, series = cache[key]
+        if time.time() - fetched <= options.cache_ttl:
+            return series
+
     try:
-        conn.request('GET', url)
-        res = conn.getresponse()
-        datapoints = res.read()
-        conn.close()
-    except socket.error, e:
-        print 'ERROR: couldn\'t GET %s from %s: %s' % (url, tsd, e)
-        sys.exit(2)
-
-    if res.status != 200:
-        print 'CRITICAL: status = %d when talking to %s:%d' % (res.status, options.host, options.port)
+        with run.phase('fetch'):
+            status, datapoints = run.get(options.host, options.port, url)
+    except FetchError, e:
+        sys.exit(run.critical(str(e)))
+
+    if status != 200:
+        details = None
         if options.verbose:
-            print 'TSD said:'
-            print datapoints
-        sys.exit(2)
+            details = ['TSD said:', datapoints]
+        sys.exit(run.critical('status = %d when talking to %s:%d' % (
+            status, options.host, options.port), details=details))
 
     if options.verbose:
         print datapoints
     datapoints = datapoints.splitlines()
 
-    ret = []
+    # Each line is "metric timestamp value tags...", and the tags tell the
+    # series apart when the query returns more than one.
+    series, ret = {}, []
     for datapoint in datapoints:
         datapoint = datapoint.split()
         ts = int(datapoint[1])
@@ -445,7 +583,20 @@ def get_datapoints(options, url):
             val = float(val)
         else:
             val = int(val)
-        ret.append((ts, val))
+        name = ' '.join(datapoint[3:])
+        if name not in series:
+            series[name] = []
+            ret.append(series[name])
+        series[name].append((ts, val))
+    for datapoints in ret:
+        datapoints.sort()
+
+    if options.cache_ttl > 0:
+        now = time.time()
+        for old in cache.keys():
+            if now - cache.get(old, (now, None))[0] > options.cache_ttl:
+                cache.pop(old, None)
+        cache[key] = (now, ret)
     return ret
 
 
@@ -0,0 +1,271 @@
+'''plugin_runtime.py -- shared plumbing for the Python plugins
+
+Every Python plugin in this repository used to carry its own copy of the
+status helpers and its own way of talking HTTP. This module is the one
+place for that now. Keep it next to the plugins; they import it from the
+directory they live in.
+
+A plugin creates one Run at the top of main():
+
+    run = Run(options.timeout)
+    with run.phase('fetch'):
+        status, body = run.get(host, port, '/stats')
+    return run.okay('all good', ['latency=%dms' % ms])
+
+The timeout is a deadline for the whole run. Every request made through
+the run gets whatever time is left, and is cut off when it runs out no
+matter how slowly the server answers, so a plugin with several requests
+can't take several times its timeout. HTTP connections are kept alive
+in a pool shared by every run in the process and ask for gzip encoded
+responses. The emitters print the standard Nagios status line, with the
+time spent in each phase added to the perfdata, and return the exit code.
+
+This script originally from Mark's Nagios Plugins:
+    https://github.com/xb95/nagios-plugins
+
+Copyright (c) 2012 by Bump Technologies, Inc, and authors and
+contributors. Please see the above linked repository for licensing
+information.
+
+'''
+
+import socket
+import thread
+import time
+from contextlib import contextmanager
+
+
+OK, WARNING, CRITICAL, UNKNOWN = 0, 1, 2, 3
+HEADERS = ('OK', 'WARNING', 'CRITICAL', 'UNKNOWN')
+
+
+class FetchError(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    '''Keeps idle HTTP connections around by host and port so the next
+    request to the same server skips the TCP handshake.
+
+    '''
+
+    def __init__(self):
+        self.idle = {}
+        self.lock = thread.allocate_lock()
+
+    def request(self, host, port, path, deadline=None):
+        '''GETs path and returns (status, body), with the body already
+        decompressed, giving up when the deadline (a time.time() value)
+        passes. A kept-alive connection the server has since closed is
+        retried once on a fresh one, with whatever time is left.
+
+        '''
+        # httplib drags in ssl, tempfile and friends, which is a big part
+        # of our startup time, so only the plugins that talk HTTP load it.
+        import httplib
+        try:
+            conn, reused = self._get(host, port, time_left(deadline))
+            try:
+                return self._request(conn, path, deadline)
+            except (httplib.HTTPException, socket.error), e:
+                conn.close()
+                if not reused or isinstance(e, socket.timeout):
+                    raise
+            conn = httplib.HTTPConnection(host, port, timeout=time_left(deadline))
+            try:
+                return self._request(conn, path, deadline)
+            except:
+                conn.close()
+                raise
+        except (httplib.HTTPException, socket.error), e:
+            raise FetchError('GET %s from %s:%d failed: %s' % (path, host, port, e))
+
+    def _request(self, conn, path, deadline):
+        import httplib, zlib
+        conn.request('GET', path, headers={'Accept-Encoding': 'gzip'})
+        watchdog = Watchdog(conn.sock, deadline)
+        try:
+            res = conn.getresponse()
+            body = res.read()
+        except (httplib.HTTPException, socket.error):
+            if watchdog.stop():
+                raise socket.timeout('timed out')
+            raise
+        if watchdog.stop():
+            # httplib can take a response cut short for a complete one.
+            raise socket.timeout('timed out')
+        if res.will_close:
+            conn.close()
+        else:
+            self._put(conn)
+        if res.getheader('content-encoding') == 'gzip':
+            try:
+                body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+            except zlib.error, e:
+                raise httplib.HTTPException('bad gzip body: %s' % e)
+        return res.status, body
+
+    def _get(self, host, port, timeout):
+        self.lock.acquire()
+        try:
+            conns = self.idle.get((host, port))
+            if conns:
+                conn = conns.pop()
+                conn.timeout = timeout
+                conn.sock.settimeout(timeout)
+                return conn, True
+        finally:
+            self.lock.release()
+        import httplib
+        return httplib.HTTPConnection(host, port, timeout=timeout), False
+
+    def _put(self, conn):
+        self.lock.acquire()
+        try:
+            self.idle.setdefault((conn.host, conn.port), []).append(conn)
+        finally:
+            self.lock.release()
+
+pool = ConnectionPool()
+
+
+class Watchdog(object):
+    '''Shuts a socket down when the deadline passes. A socket timeout only
+    limits each recv on its own, so without this a server that trickles
+    its response out a byte at a time could keep us reading long past
+    the deadline.
+
+    '''
+
+    def __init__(self, sock, deadline):
+        self.sock = sock
+        self.fired = self.stopped = False
+        self.lock = thread.allocate_lock()
+        self.timer = None
+        if deadline is not None:
+            import threading
+            self.timer = threading.Timer(max(deadline - time.time(), 0), self.expire)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def expire(self):
+        with self.lock:
+            if self.stopped:
+                return
+            self.fired = True
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def stop(self):
+        '''Stops the watchdog. Returns whether it went off.'''
+        with self.lock:
+            self.stopped = True
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer.join()
+        return self.fired
+
+
+def time_left(deadline):
+    '''Returns the seconds left until deadline, or None if there is none.
+    Raises socket.timeout if it has already passed.
+
+    '''
+    if deadline is None:
+        return None
+    left = deadline - time.time()
+    if left <= 0:
+        raise socket.timeout('timed out')
+    return left
+
+
+class Run(object):
+    '''One invocation of a plugin. Holds the deadline, the phase timings
+    and the emitters that print the result.
+
+    '''
+
+    def __init__(self, timeout=None):
+        self.started = time.time()
+        self.deadline = None
+        if timeout:
+            self.deadline = self.started + timeout
+        self.phases = []
+
+    def remaining(self):
+        '''Returns the seconds left until the deadline (None if there is no
+        deadline). Raises FetchError if it has already passed.
+
+        '''
+        if self.deadline is None:
+            return None
+        left = self.deadline - time.time()
+        if left <= 0:
+            raise FetchError('timed out after %.1fs' % (time.time() - self.started))
+        return left
+
+    @contextmanager
+    def phase(self, name):
+        '''Times the enclosed block. Time spent in a phase that is entered
+        more than once is added up.
+
+        '''
+        start = time.time()
+        try:
+            yield
+        finally:
+            for entry in self.phases:
+                if entry[0] == name:
+                    entry[1] += time.time() - start
+                    break
+            else:
+                self.phases.append([name, time.time() - start])
+
+    def expired(self):
+        '''Returns whether the deadline has passed.'''
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def get(self, host, port, path, timeout=None):
+        '''GETs path from host:port through the shared pool, within the time
+        left on the deadline (and within timeout, if given). Returns
+        (status, body).
+
+        '''
+        left = self.remaining()
+        deadline = self.deadline
+        if timeout is not None and (left is None or timeout < left):
+            deadline = time.time() + timeout
+        return pool.request(host, port, path, deadline)
+
+    def emit(self, code, msg, perfdata=None, details=None):
+        '''Prints the Nagios status line and returns code. perfdata is a
+        list of "label=value" strings; the phase timings are added to it.
+        details, if given, are printed as extra lines of output.
+
+        '''
+        perfdata = list(perfdata or [])
+        for name, elapsed in self.phases:
+            perfdata.append('time_%s=%.6fs' % (name, elapsed))
+        if self.phases:
+            perfdata.append('time_total=%.6fs' % (time.time() - self.started))
+        line = '%s: %s' % (HEADERS[code], msg)
+        if perfdata:
+            line += ' | ' + ' '.join(perfdata)
+        print line
+        for detail in details or ():
+            print detail
+        return code
+
+    def okay(self, msg, perfdata=None, details=None):
+        return self.emit(OK, msg, perfdata, details)
+
+    def warning(self, msg, perfdata=None, details=None):
+        return self.emit(WARNING, msg, perfdata, details)
+
+    def critical(self, msg, perfdata=None, details=None):
+        return self.emit(CRITICAL, msg, perfdata, details)
+
+    def unknown(self, msg, perfdata=None, details=None):
+        return self.emit(UNKNOWN, msg, perfdata, details)
@@ -0,0 +1,426 @@
+#!/usr/bin/python
+
+'''plugin_scheduler.py -- run the Python plugins inside one process
+
+Running the plugins as Nagios active checks costs a fork, an exec and a
+Python startup per check. This script imports the plugins instead and
+calls their main() functions on a pool of worker threads, on a schedule
+of its own, and hands the results to Nagios as passive check results.
+
+    plugin_scheduler.py -s /etc/nagios/plugins.schedule \
+        -c /var/lib/nagios3/rw/nagios.cmd
+
+The schedule has one check per line, with the fields separated by ";":
+
+    HOST;SERVICE;INTERVAL;JITTER;PLUGIN ARGS...
+
+    db01;Riak latency;60;10;check_riak.py -H db01 --95th 10,20,15,25
+    tsd01;TSD load;300;30;check_tsd.py -m proc.loadavg.15min -w 5 -c 10
+    db01;;60;5;check_riak_ring.py db01 db02 db03
+
+INTERVAL and JITTER are in seconds. Every run is scheduled INTERVAL
+seconds after the previous one, moved by up to JITTER either way, so
+checks with the same interval don't all fire together. Leave SERVICE
+empty to submit a host check result. PLUGIN is one of the Python plugins
+in this directory. Blank lines and lines starting with # are ignored.
+
+Results are written to the Nagios external command file with -c, or as
+check result files in the spool directory Nagios reads (its
+check_result_path) with -d. A check that is still running when it comes
+due again is skipped rather than queued twice. If it has been running for
+longer than --check-timeout (its interval by default), an UNKNOWN "check
+still running" result is submitted in its place every time it comes due,
+and another worker is started so the hung one doesn't shrink the pool.
+
+With --stats-file, the scheduler keeps a JSON file up to date with the
+queue depth, how late checks have been started and how long each check
+has taken.
+
+This script originally from Mark's Nagios Plugins:
+    https://github.com/xb95/nagios-plugins
+
+Copyright (c) 2012 by Bump Technologies, Inc, and authors and
+contributors. Please see the above linked repository for licensing
+information.
+
+'''
+
+import heapq
+import json
+import os
+import random
+import shlex
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from optparse import OptionParser
+from Queue import Queue
+from StringIO import StringIO
+
+
+PLUGINS = ('check_aacraid', 'check_logscan', 'check_redis_repl', 'check_riak',
+           'check_riak_ring', 'check_stud_server', 'check_tsd')
+
+
+class ThreadOutput(object):
+    '''Stands in for sys.stdout and sys.stderr so that what a plugin prints
+    from a worker thread is captured for that check alone. Anything
+    printed outside of a check goes to the real stream.
+
+    '''
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def capture(self):
+        self.local.buf = StringIO()
+
+    def release(self):
+        buf = self.local.buf
+        del self.local.buf
+        return buf.getvalue()
+
+    def write(self, data):
+        getattr(self.local, 'buf', self.stream).write(data)
+
+    def flush(self):
+        getattr(self.local, 'buf', self.stream).flush()
+
+
+class Check(object):
+    '''One line of the schedule.'''
+
+    def __init__(self, host, service, interval, jitter, argv):
+        self.host, self.service = host, service
+        self.interval, self.jitter = interval, jitter
+        self.argv = argv
+        self.plugin = os.path.basename(argv[0])
+        if self.plugin.endswith('.py'):
+            self.plugin = self.plugin[:-3]
+        self.main = None
+        self.running = False
+        self.started = None
+        self.replaced = False
+        self.runs = self.skipped = self.stuck = 0
+        self.last_duration = self.max_duration = self.total_duration = 0.0
+        self.last_lateness = self.max_lateness = 0.0
+        self.last_code = None
+
+    def name(self):
+        if self.service:
+            return '%s;%s' % (self.host, self.service)
+        return self.host
+
+    def next_due(self, due):
+        return due + self.interval + random.uniform(-self.jitter, self.jitter)
+
+
+def main(argv):
+    '''Loads the schedule and the plugins, then runs checks forever.'''
+    parser = OptionParser()
+    parser.add_option('-s', '--schedule', dest='schedule', metavar='FILE',
+                      help='File listing the checks to run.')
+    parser.add_option('-c', '--command-file', dest='command_file', metavar='FILE',
+                      help='Submit results to the Nagios external command file.')
+    parser.add_option('-d', '--spool-dir', dest='spool_dir', metavar='DIR',
+                      help='Write check result files into the Nagios spool directory.')
+    parser.add_option('-w', '--workers', dest='workers', type='int', default=8,
+                      metavar='N', help='How many checks to run at once.')
+    parser.add_option('-T', '--check-timeout', dest='check_timeout', type='float',
+                      metavar='SECONDS', help='Report a check that has been running this'
+                      ' long as UNKNOWN (default: its interval).')
+    parser.add_option('--stats-file', dest='stats_file', metavar='FILE',
+                      help='Keep scheduler statistics in FILE.')
+    parser.add_option('--stats-interval', dest='stats_interval', type='int', default=60,
+                      metavar='SECONDS', help='How often to rewrite the stats file.')
+    (options, args) = parser.parse_args(argv[1:])
+
+    if not options.schedule:
+        parser.error('You must give a schedule file (-s).')
+    elif bool(options.command_file) == bool(options.spool_dir):
+        parser.error('Give exactly one of --command-file and --spool-dir.')
+    elif options.workers < 1:
+        parser.error('--workers must be at least 1.')
+    elif options.check_timeout is not None and options.check_timeout <= 0:
+        parser.error('--check-timeout must be positive.')
+
+    try:
+        checks = load_schedule(options.schedule)
+    except (IOError, ValueError), e:
+        print >>sys.stderr, 'Unable to load schedule: %s' % e
+        return 1
+    if options.command_file:
+        submit = CommandFileWriter(options.command_file)
+    else:
+        submit = SpoolWriter(options.spool_dir)
+
+    sys.stdout = ThreadOutput(sys.stdout)
+    sys.stderr = ThreadOutput(sys.stderr)
+
+    queue = Queue()
+    for _ in range(options.workers):
+        start_worker(queue, submit)
+
+    # Spread the first runs over one interval so a restart doesn't fire
+    # every check at once.
+    now = time.time()
+    pending = [(now + random.uniform(0, check.interval), i, check)
+               for i, check in enumerate(checks)]
+    heapq.heapify(pending)
+    started = now
+    next_stats = now
+    while True:
+        now = time.time()
+        while pending[0][0] <= now:
+            due, i, check = heapq.heappop(pending)
+            if check.running:
+                check.skipped += 1
+                report_stuck(check, options.check_timeout or check.interval,
+                             queue, submit, now)
+            else:
+                check.running = True
+                queue.put((due, check))
+            heapq.heappush(pending, (max(check.next_due(due), now), i, check))
+
+        if options.stats_file and now >= next_stats:
+            try:
+                write_stats(options.stats_file, started, queue, checks)
+            except (IOError, OSError), e:
+                print >>sys.stderr, 'Unable to write stats: %s' % e
+            next_stats = now + options.stats_interval
+        time.sleep(max(min(pending[0][0] - time.time(), 1), 0))
+
+
+def load_schedule(path):
+    '''Parses the schedule file and imports the plugins it uses. Returns a
+    list of Checks, or raises ValueError naming the offending line.
+
+    '''
+    here = os.path.dirname(os.path.abspath(__file__))
+    if here not in sys.path:
+        sys.path.insert(0, here)
+
+    checks = []
+    f = open(path)
+    try:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split(';', 4)
+            if len(fields) != 5:
+                raise ValueError('%s line %d: expected "HOST;SERVICE;INTERVAL;JITTER;PLUGIN ARGS"'
+                                 % (path, lineno))
+            host, service, interval, jitter, command = fields
+            try:
+                interval, jitter = float(interval), float(jitter)
+            except ValueError:
+                raise ValueError('%s line %d: bad interval or jitter' % (path, lineno))
+            if interval <= 0 or jitter < 0 or jitter >= interval:
+                raise ValueError('%s line %d: interval must be positive and jitter '
+                                 'less than the interval' % (path, lineno))
+            check = Check(host.strip(), service.strip(), interval, jitter, shlex.split(command))
+            if check.plugin not in PLUGINS:
+                raise ValueError('%s line %d: unknown plugin %s' % (path, lineno, check.plugin))
+            check.main = __import__(check.plugin).main
+            checks.append(check)
+    finally:
+        f.close()
+    if not checks:
+        raise ValueError('%s has no checks' % path)
+    return checks
+
+
+def start_worker(queue, submit):
+    worker = threading.Thread(target=work, args=(queue, submit))
+    worker.daemon = True
+    worker.start()
+
+
+def report_stuck(check, limit, queue, submit, now):
+    '''Submits an UNKNOWN result for a check that has been running for
+    longer than limit seconds. The first time, another worker is started
+    to stand in for the one the check is holding.
+
+    '''
+    started = check.started
+    if started is None or now - started < limit:
+        return
+    check.stuck += 1
+    if not check.replaced:
+        check.replaced = True
+        start_worker(queue, submit)
+    try:
+        submit(check, 3, 'UNKNOWN: check still running after %ds' % (now - started),
+               now, now, 0.0)
+    except (IOError, OSError), e:
+        print >>sys.stderr, 'Unable to submit %s: %s' % (check.name(), e)
+
+
+def work(queue, submit):
+    while True:
+        due, check = queue.get()
+        start = check.started = time.time()
+        code, output = run_check(check)
+        finish = time.time()
+
+        check.runs += 1
+        check.last_code = code
+        check.last_lateness = start - due
+        check.max_lateness = max(check.max_lateness, check.last_lateness)
+        check.last_duration = finish - start
+        check.max_duration = max(check.max_duration, check.last_duration)
+        check.total_duration += check.last_duration
+        check.started = None
+        check.running = False
+
+        try:
+            submit(check, code, output, start, finish, start - due)
+        except (IOError, OSError), e:
+            print >>sys.stderr, 'Unable to submit %s: %s' % (check.name(), e)
+        if check.replaced:
+            # Another worker took over while we were stuck; leave it to that.
+            check.replaced = False
+            return
+
+
+def run_check(check):
+    '''Calls the plugin's main() the way it would be called from the
+    command line. Returns the exit code and what the plugin printed.
+
+    '''
+    sys.stdout.capture()
+    sys.stderr.capture()
+    try:
+        try:
+            code = check.main(list(check.argv))
+        except SystemExit, e:
+            code = e.code
+            if code is not None and not isinstance(code, int):
+                print code
+                code = 1
+        except Exception:
+            print 'UNKNOWN: %s raised an exception' % check.plugin
+            traceback.print_exc(file=sys.stdout)
+            code = 3
+    finally:
+        output = sys.stdout.release()
+        errors = sys.stderr.release()
+
+    if code is None:
+        code = 0
+    if code not in (0, 1, 2, 3):
+        code = 3
+    output = output.strip() or errors.strip() or '(No output returned from plugin)'
+    return code, output
+
+
+class CommandFileWriter(object):
+    '''Submits results as PROCESS_SERVICE_CHECK_RESULT (or _HOST_) lines
+    written to the Nagios external command file.
+
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def __call__(self, check, code, output, start, finish, latency):
+        output = output.replace('\\', '\\\\').replace('\n', '\\n')
+        if check.service:
+            line = '[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s\n' % (
+                finish, check.host, check.service, code, output)
+        else:
+            line = '[%d] PROCESS_HOST_CHECK_RESULT;%s;%d;%s\n' % (
+                finish, check.host, code, output)
+        self.lock.acquire()
+        try:
+            f = open(self.path, 'a')
+            try:
+                f.write(line)
+            finally:
+                f.close()
+        finally:
+            self.lock.release()
+
+
+class SpoolWriter(object):
+    '''Submits results as check result files in the directory Nagios
+    reaps them from, each followed by the ".ok" file that tells Nagios
+    the result is complete.
+
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, check, code, output, start, finish, latency):
+        lines = [
+            '### Passive Check Result File ###',
+            'file_time=%d' % int(finish),
+            '',
+            'host_name=%s' % check.host,
+        ]
+        if check.service:
+            lines.append('service_description=%s' % check.service)
+        lines += [
+            'check_type=1',
+            'check_options=0',
+            'scheduled_check=0',
+            'reschedule_check=0',
+            'latency=%f' % latency,
+            'start_time=%f' % start,
+            'finish_time=%f' % finish,
+            'early_timeout=0',
+            'exited_ok=1',
+            'return_code=%d' % code,
+            'output=%s' % output.replace('\\', '\\\\').replace('\n', '\\n'),
+            '',
+        ]
+        fd, name = tempfile.mkstemp(prefix='c', dir=self.path)
+        f = os.fdopen(fd, 'w')
+        try:
+            f.write('\n'.join(lines))
+        finally:
+            f.close()
+        open(name + '.ok', 'w').close()
+
+
+def write_stats(path, started, queue, checks):
+    '''Atomically rewrites the stats file.'''
+    stats = {
+        'time': int(time.time()),
+        'uptime': int(time.time() - started),
+        'queue_depth': queue.qsize(),
+        'running': len([c for c in checks if c.running]),
+        'checks': [],
+    }
+    for check in checks:
+        stats['checks'].append({
+            'name': check.name(),
+            'runs': check.runs,
+            'skipped': check.skipped,
+            'stuck': check.stuck,
+            'last_code': check.last_code,
+            'last_duration': round(check.last_duration, 6),
+            'max_duration': round(check.max_duration, 6),
+            'avg_duration': round(check.total_duration / check.runs, 6) if check.runs else None,
+            'last_lateness': round(check.last_lateness, 6),
+            'max_lateness': round(check.max_lateness, 6),
+        })
+    fd, tmp = tempfile.mkstemp(prefix='.scheduler', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        f = os.fdopen(fd, 'w')
+        json.dump(stats, f, indent=1)
+        f.close()
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))